@@ -0,0 +1,47 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import numpy as np
+
+
+def clock_run(times, last_event_time, minimal_event_diff):
+    """ Computes synchronized times of a run of internal events at once.
+        The result is the same as of the recurrence
+        new[i] = max(times[i], new[i - 1] + minimal_event_diff), which is
+        new[i] = i * diff + max(last + diff, max(times[j] - j * diff), j <= i).
+
+        Arguments:
+        times -- int64 array of original times (with the time offset added),
+                 or a 2D array with a column per setting, the other
+                 arguments are then arrays of a value per column
+        last_event_time -- synchronized time of the preceding event, must not
+                           be 0 (the first event of a trace keeps its time)
+        minimal_event_diff -- minimal difference between 2 events
+    """
+    steps = np.arange(len(times), dtype=np.int64)
+    if np.ndim(times) > 1:
+        steps = steps[:, np.newaxis]
+    steps = steps * minimal_event_diff
+    bounds = np.maximum.accumulate(times - steps)
+    np.maximum(bounds, last_event_time + minimal_event_diff, out=bounds)
+    return bounds + steps
+
+def backward_offsets(limits, violations, initial_offset):
+    """ Computes offsets of the backward amortization at once. Walking events
+        backwards, the offset is lowered to the limit of every send event and
+        raised by the violation of every receive event after the receive event
+        got shifted. With a[k] the sum of violations before the k-th event,
+        offset[k] = a[k] + min(initial, min(limits[j] - a[j]), j <= k).
+
+        Arguments:
+        limits -- int64 array of offsets allowed by events in the backward
+                  order, the maximum of int64 for non-send events
+        violations -- int64 array of violations in the backward order, 0 for
+                      events other than violating receive events
+        initial_offset -- violation of the last violating receive event
+    """
+    added = np.cumsum(violations) - violations
+    bounds = np.minimum.accumulate(limits - added)
+    np.minimum(bounds, initial_offset, out=bounds)
+    return bounds + added
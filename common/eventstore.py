@@ -0,0 +1,104 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import numpy as np
+from array import array
+
+# Number of events patched at once by the vectorized export
+PATCH_CHUNK = 1 << 20
+
+# Byte positions of a time (struct "<Q") relative to its start
+TIME_BYTES = np.arange(8, dtype=np.int64)
+
+
+class EventStore(object):
+    """ Synchronized events of one trace kept in columns, an event takes
+        a type character and two integers instead of a list of objects.
+        Bytes of events stay in the original data, the export overwrites
+        times of events within a copy of the data.
+
+        Attributes:
+        types -- type characters of events
+        times -- synchronized times of events
+        pointers -- positions of events' times within the original data
+    """
+
+    def __init__(self):
+        self.types = array("c")
+        self.times = array("l")
+        self.pointers = array("l")
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getstate__(self):
+        return (self.types.tostring(), self.times.tostring(),
+                self.pointers.tostring())
+
+    def __setstate__(self, state):
+        self.__init__()
+        for column, data in zip((self.types, self.times, self.pointers),
+                                state):
+            column.fromstring(data)
+
+    def add(self, event_type):
+        """ Stores a new event, its time is set by set_time """
+        self.types.append(event_type)
+
+    def set_time(self, time, pointer):
+        """ Sets the synchronized time of the last stored event
+
+            Arguments:
+            time -- the synchronized time
+            pointer -- position of the event's time within the data
+        """
+        self.times.append(time)
+        self.pointers.append(pointer)
+
+    def extend(self, types, times, pointers):
+        """ Stores a run of events given by numpy arrays of type characters
+            (as numbers), synchronized times and positions of times
+        """
+        self.types.fromstring(types.astype(np.uint8).tostring())
+        self.times.fromstring(times.astype(np.int_).tostring())
+        self.pointers.fromstring(pointers.astype(np.int_).tostring())
+
+    def shift(self, offsets, start=0):
+        """ Adds offsets to times of events from the start position """
+        times = np.frombuffer(self.times, dtype=np.int_)
+        times[start : start + len(offsets)] += offsets
+
+    def patch(self, export, count=None, base=0):
+        """ Overwrites original times within a writable copy of the data
+            by the synchronized ones
+
+            Arguments:
+            export -- a copy of the data supporting the buffer interface
+            count -- count of events to be patched from the first one, all
+                     of them if None
+            base -- position of the copy within the original data
+        """
+        if count is None:
+            count = len(self.times)
+        raw = np.frombuffer(export, dtype=np.uint8)
+        times = np.frombuffer(self.times, dtype=np.int_)[:count]
+        pointers = np.frombuffer(self.pointers, dtype=np.int_)[:count] - base
+        for i in xrange(0, count, PATCH_CHUNK):
+            chunk = times[i : i + PATCH_CHUNK].astype("<u8").view(np.uint8)
+            positions = pointers[i : i + PATCH_CHUNK, np.newaxis] + TIME_BYTES
+            raw[positions] = chunk.reshape(-1, 8)
+
+    def type_counts(self, count=None):
+        """ Returns counts of the first count events (all if None) by type
+            as a dictionary
+        """
+        types = np.frombuffer(self.types, dtype=np.uint8)[:count]
+        counts = np.bincount(types, minlength=256)
+        return dict((chr(t), int(counts[t])) for t in np.flatnonzero(counts))
+
+    def drop(self, count):
+        """ Forgets the first count events """
+        del self.types[:count]
+        del self.times[:count]
+        del self.pointers[:count]
@@ -0,0 +1,95 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import json
+import time
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+
+class Stats(object):
+    """ Wall times of phases of the synchronization and counters of one
+        process (an MPI rank)
+
+        Attributes:
+        times -- phase name -> seconds spent in the phase
+        counters -- counter name -> value
+    """
+
+    def __init__(self):
+        self.times = OrderedDict()
+        self.counters = Counter()
+        self._lap = time.time()
+
+    def lap(self, name):
+        """ Adds the time since the previous lap (or the creation) to
+            the phase, for phases following each other
+        """
+        now = time.time()
+        self.add_time(name, now - self._lap)
+        self._lap = now
+
+    @contextmanager
+    def phase(self, name):
+        """ Adds the time spent within the with statement to the phase """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def timed(self, name, function):
+        """ Returns the function adding time of its calls to the phase """
+        def call(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return call
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def count_trace(self, trace):
+        """ Counts events of a synchronized trace by type, its messages and
+            the size of its exported data
+        """
+        counts = trace.event_counts()
+        for event_type, count in counts.iteritems():
+            self.count("events_" + event_type, count)
+        self.count("messages_sent", trace.sent_count())
+        self.count("messages_received", counts.get("R", 0))
+        self.count("bytes_written", len(trace.data))
+
+    def record(self):
+        """ Returns times and counters as a dictionary """
+        return { "times" : dict(self.times),
+                 "counters" : dict(self.counters) }
+
+
+def summarize(records):
+    """ Reduces records of processes (see Stats.record) into minimum, average
+        and maximum of every time and counter, a missing one counts as 0
+    """
+    result = OrderedDict()
+    result["processes"] = len(records)
+    for kind in ("times", "counters"):
+        names = sorted(set(name for record in records
+                           for name in record[kind]))
+        reduced = OrderedDict()
+        for name in names:
+            values = [ record[kind].get(name, 0) for record in records ]
+            reduced[name] = OrderedDict((("min", min(values)),
+                                         ("avg", float(sum(values)) /
+                                                 len(values)),
+                                         ("max", max(values))))
+        result[kind] = reduced
+    return result
+
+def write_summary(filename, records):
+    """ Stores the summary of records (see summarize) as JSON """
+    with open(filename, "w") as f:
+        json.dump(summarize(records), f, indent=2)
+        f.write("\n")
@@ -0,0 +1,537 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import numpy as np
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque, Counter
+from threadtrace import Trace
+from traceindex import IndexCursor
+from batchclock import clock_run, backward_offsets
+from eventstore import EventStore
+
+# Count of events added to the data list before streamed events are
+# finalized again
+STREAM_WINDOW = 1 << 16
+
+# Shortest run of events whose times are computed by clock_run, numpy calls
+# cost more than the scalar loop over shorter runs
+BATCH_CLOCK_MIN_RUN = 16
+
+
+class SyncedTraceBase(Trace):
+    """ Synchronization of events of one process shared by the sequential
+        (SyncedTrace) and the parallel version (ParallelSyncedTrace).
+        Subclasses exchange sent and receive times with other processes by
+        _extra_time and _extra_event_send.
+    """
+    
+    def __init__(self, data, process_id, pointer_size, minimal_event_diff, \
+                                     minimum_msg_delay, \
+                                     forward_amort, \
+                                     backward_amort, \
+                                     index=False, \
+                                     batch_clock=False, \
+                                     stream=None, \
+                                     index_cache=None):
+        """ Arguments:
+            data -- content of a process's *.ktt file (a string or a memory
+                    map of the file)
+            process_id -- ID of the process
+            pointer_size -- 4 or 8, type of binary data within the *.ktt file
+            minimal_event_diff -- minimal difference between 2 events of
+                                  the process [ns]
+            minimum_msg_delay -- minimum message delay of messages from
+                                 one process to another [ns]
+            forward_amort -- True/False, turns on/off forward amortization
+            backward_amort -- True/False, turns on/off backward amortization
+            index -- if True, the trace is indexed (see TraceIndex) and
+                     events are taken from the index instead of being
+                     decoded (see process_run)
+            batch_clock -- if True, runs of events between receive events are
+                           processed at once (see process_run), the trace
+                           is indexed
+            stream -- None or (file, position), events are written into
+                      the file from the position once no later correction
+                      can change them (see _finalize) and dropped
+            index_cache -- None or the path of the trace file, the index
+                           is cached next to the file (see build_index)
+        """
+        Trace.__init__(self, data, process_id, pointer_size)
+        self.index_cache = index_cache
+        if index or batch_clock:
+            self.build_index()
+        self._cursor = None
+        self._minimal_event_diff = minimal_event_diff
+        self._minimum_msg_delay = minimum_msg_delay
+        self._forward_amort = forward_amort
+        self._backward_amort = backward_amort
+        self._events = EventStore()
+        self._batch_clock = batch_clock
+        self._stream = stream
+        # Count of events dropped from the event store and the end of 
+        # the written data
+        self._base = 0
+        self._written = 0
+        # Counts of written events by type
+        self._written_types = Counter()
+        self._next_finalize = STREAM_WINDOW
+        self._last_event_time = 0
+        self._send_events = SendEvents()
+        self._violating_recv_events = OrderedDict()
+        self._last_violating_recv_index = 0
+        self._last_received_sent_time = 0
+        self._last_receive_event_time = 0
+        
+    def _clock_check(self, time, start_pointer, end_pointer=False, \
+                     is_receive=False, sent_time=0):
+        """ Checks, computes and repairs an event timestamp
+            
+            Arguments:
+            time -- a timestamp to be checked
+            start_pointer -- a pointer value before an event unpacking/reading
+            end_pointer -- a pointer value after the event unpacking/reading, 
+                            if False self.pointer is used
+            is_receive -- marks a receive event
+            sent_time -- a timestamp of corresponding send event
+         """
+        newtime = 0
+        
+        if not is_receive:
+            newtime = self._clock(time + self.time_offset)
+        else:
+            newtime = self._clock_receive(time + self.time_offset, sent_time)
+        
+        # Save time to the data list
+        self._repair_time(newtime, start_pointer, end_pointer)
+        
+        return newtime
+    
+    def _clock(self, time):
+        """ Computes a new time for a process's internal event 
+            
+            Arguments:
+            time -- the time to be fixed
+        """
+        newtime = 0
+        if self._last_event_time != 0:
+            newtime = max([time, self._last_event_time + \
+                           self._minimal_event_diff])
+        else:
+            newtime = time
+        
+        self._last_event_time = newtime
+        
+        return newtime
+    
+    def _clock_receive(self, time, sent_time):
+        """ Computes a new time for a process's receive event 
+            
+            Arguments:
+            time -- the time to be fixed
+            sent_time -- time of the corresponding send event
+        """
+        newtime = 0
+        if self._last_event_time != 0:
+            newtime = max([sent_time + self._minimum_msg_delay, time, \
+                           self._last_event_time + \
+                           self._minimal_event_diff])
+        else:
+            newtime = max([sent_time + self._minimum_msg_delay, time])
+        
+        if self._forward_amort:
+            self._forward_amortization(time, newtime)
+        if self._backward_amort:
+            if newtime > time:
+                position = self._base + len(self._events) - 1
+                self._violating_recv_events[position] = newtime - time
+                self._last_violating_recv_index = position
+        
+        self._last_event_time = newtime
+        self._last_receive_event_time = newtime
+        
+        return newtime
+    
+    def _forward_amortization(self, origin_time, new_time):
+        """ Checks shift of a receive event. If a shift exists the time offset 
+            is increased to keep the spacing between two events
+            (Forward amortization)
+            
+            Arguments:
+            origin_time -- original timestamp of an receive event
+            new_time -- corrected/synchronized timestamp of the event
+        """
+        if new_time > origin_time:
+            self.time_offset += new_time - origin_time
+    
+    def process_next(self):
+        """ Processes the next event, or the whole run of events up to the 
+            next receive event if the trace is indexed (see process_run)
+        """
+        if self.index is not None:
+            self.process_run()
+        else:
+            self.process_event()
+        if self._stream is not None and \
+                len(self._events) >= self._next_finalize:
+            self._finalize()
+    
+    def process_run(self):
+        """ Processes the next event if it is a receive event, otherwise all
+            events up to the next receive event at once. Events are taken
+            from the index, they are not decoded. Times of the run are
+            computed by clock_run if the batch clock is on and the run is not
+            shorter than BATCH_CLOCK_MIN_RUN, otherwise event by event.
+        """
+        cursor = self._index_cursor()
+        if cursor.sender() is not None:
+            self._process_indexed_receive(cursor)
+            return
+        first = cursor.position
+        last = cursor.run_end()
+        if self._batch_clock and self._last_event_time != 0 and \
+                last - first >= BATCH_CLOCK_MIN_RUN:
+            index = self.index
+            times = clock_run(index.times[first:last] + self.time_offset,
+                              self._last_event_time, self._minimal_event_diff)
+            self._last_event_time = int(times[-1])
+            self._events.extend(index.types[first:last], times,
+                                index.offsets[first:last] + 1)
+            times = times.tolist()
+        else:
+            times = self._clock_indexed_run(cursor, last)
+        
+        # Sends of the run, i is the position within the chunk
+        position = self._base + len(self._events) - len(times) - first
+        start = cursor.start
+        i = cursor.types.find("M", first - start, last - start)
+        while i != -1:
+            for target_id in cursor.targets(i):
+                self._extra_event_send(times[start + i - first], target_id,
+                                       position + start + i)
+            i = cursor.types.find("M", i + 1, last - start)
+        cursor.move(last)
+        self.pointer = cursor.pointer(len(self.data))
+    
+    def _index_cursor(self):
+        """ Returns the cursor of the index moved to the pointer """
+        if self._cursor is None:
+            self._cursor = IndexCursor(self.index)
+        self._cursor.seek(self.pointer)
+        return self._cursor
+    
+    def _clock_indexed_run(self, cursor, last):
+        """ Computes and stores times of the events from the cursor up to
+            the last ordinal (a run without receive events) one by one,
+            the same as _clock does, and returns them
+        """
+        start = cursor.start
+        first = cursor.position - start
+        last -= start
+        events = self._events
+        offset = self.time_offset
+        diff = self._minimal_event_diff
+        last_time = self._last_event_time
+        times = []
+        for i in xrange(first, last):
+            time = cursor.times[i] + offset
+            if last_time != 0 and time < last_time + diff:
+                time = last_time + diff
+            last_time = time
+            times.append(time)
+            events.add(cursor.types[i])
+            events.set_time(time, cursor.offsets[i] + 1)
+        self._last_event_time = last_time
+        return times
+    
+    def _process_indexed_receive(self, cursor):
+        """ Processes the receive event at the cursor, its time and sender
+            are taken from the index
+        """
+        i = cursor.position - cursor.start
+        self._extra_event("R")
+        self._extra_time(cursor.times[i], cursor.offsets[i] + 1, True,
+                         cursor.peers[i])
+        cursor.move(cursor.position + 1)
+        self.pointer = cursor.pointer(len(self.data))
+    
+    def _violations(self, count):
+        """ Returns violations of receive events at the first count positions
+            of the data list, 0 for other events
+        """
+        violations = np.zeros(count, dtype=np.int64)
+        for position, violation in self._violating_recv_events.iteritems():
+            position -= self._base
+            if position >= count:
+                break
+            violations[position] = violation
+        return violations
+    
+    def _finalize(self):
+        """ Writes out events which no later correction can change and drops
+            them from the data list. A send event whose messages were all
+            received without any slack (offset 0) is a cut, the backward
+            amortization never shifts it and shifts an earlier event by at
+            most the violations between the event and the cut. Offsets of
+            events before the last cut are final once receive times of all
+            send events before the cut are known. Events after the last cut
+            stay in the data list, without cuts it keeps the whole trace.
+        """
+        self._next_finalize = len(self._events) + STREAM_WINDOW
+        if len(self._events) < 2:
+            return
+        if not self._backward_amort:
+            # Times are final when computed, the last event may still
+            # collect its tokens
+            cut = len(self._events) - 1
+            self._write_stream(cut, self._events.pointers[cut] - 1)
+            return
+        limits = self._send_events.limits(len(self._events), self._base)
+        waiting = self._send_events.first_waiting()
+        if waiting is not None:
+            limits = limits[: waiting - self._base]
+        cuts = np.flatnonzero(limits == 0)
+        if len(cuts) == 0 or cuts[-1] == 0:
+            return
+        cut = int(cuts[-1])
+        offsets = backward_offsets(limits[cut : : -1],
+                                   self._violations(cut + 1)[: : -1],
+                                   np.iinfo(np.int64).max)
+        self._events.shift(offsets[: 0 : -1])
+        self._write_stream(cut, self._events.pointers[cut] - 1)
+        self._send_events.drop(self._base)
+        violations = self._violating_recv_events
+        while violations and next(iter(violations)) < self._base:
+            violations.popitem(last=False)
+    
+    def _write_stream(self, count, end):
+        """ Writes the data up to the end pointer with synchronized times of
+            the first count events of the event store into the stream and
+            drops the events
+            
+            Arguments:
+            count -- count of events to be written
+            end -- pointer to the end of the last written event
+        """
+        written = self._written
+        chunk = bytearray(self.data[written:end])
+        self._events.patch(chunk, count, written)
+        f, start = self._stream
+        f.seek(start + written)
+        f.write(chunk)
+        self._written_types.update(self._events.type_counts(count))
+        self._events.drop(count)
+        self._base += count
+        self._written = end
+    
+    def finish_stream(self):
+        """ Writes out all remaining events into the stream, call it after
+            the backward amortization
+        """
+        self._write_stream(len(self._events), len(self.data))
+    
+    def event_counts(self):
+        """ Returns counts of synchronized events by type """
+        return self._written_types + Counter(self._events.type_counts())
+    
+    def sent_count(self):
+        """ Returns the count of sent messages, one per recipient """
+        return self._send_events.count()
+    
+    def do_backward_amortization(self):
+        """ Applies the backward amortization 
+        """
+        
+        if not self._violating_recv_events:
+            return
+        
+        # Events before the base are already final (see _finalize)
+        last = self._last_violating_recv_index - self._base
+        if last <= 0:
+            return
+        # Collective messages are reduced into one, the smallest offset limits
+        limits = self._send_events.limits(last, self._base)
+        offsets = backward_offsets(
+            limits[ : : -1 ], self._violations(last)[ : : -1 ],
+            self._violating_recv_events[ self._last_violating_recv_index ])
+        self._events.shift(offsets[ : : -1 ])
+    
+    def refill_received_time(self, sent_time, received_time, receiver):
+        """ Backward amortization - adds receive time for a specific sent time 
+            and compute maximum offset
+            
+            Arguments:
+            sent_time -- time of a corresponding send event
+            receive_time -- time of a receipt of the msg to be filled
+        """
+        self._send_events.fill(receiver, received_time, received_time - \
+                               self._minimum_msg_delay - sent_time)
+    
+    def get_msg_sender(self):
+        """ Returns None or the id of a process, who is the sender of the received
+            message, if the next event is receive event
+        """
+        if self.index is not None:
+            return self._index_cursor().sender()
+        if self.get_next_event_name() == "Recv ":
+            tmp_pointer = self.pointer
+            self.pointer += 1
+            origin_id = self._read_struct_receive()[1]
+            self.pointer = tmp_pointer
+            return origin_id
+        else:
+            return None
+    
+    def get_last_received_sent_time(self):
+        """ Returns last received (got from messages) sent time. """
+        return self._last_received_sent_time
+    
+    def get_last_receive_event_time(self):
+        """ Returns time of last synchronized receive event """
+        return self._last_receive_event_time
+    
+    def _repair_time(self, time, start_pointer, end_pointer):
+        """ Stores the new time of the last event, the original one is
+            overwritten by the export
+            
+            Arguments:
+            time -- a new time to be saved
+            start_pointer -- points to the start of event's data
+            end_pointer -- points to the end of event ('s data)
+        """
+        self._events.set_time(time, start_pointer)
+    
+    def _extra_event(self, event):
+        """ Stores event symbol into trace's data """
+        self._events.add(event)
+
+
+class SendEvents(object):
+    """ Send events of a trace stored by position in parallel arrays, one
+        record per recipient of a send event.
+    
+        Attributes:
+        events -- positions of send events within the trace's data list
+        receivers -- recipients of the messages
+        receives -- received times, 0 until the receipt is known
+        offsets -- differences between received times (without the minimal
+                   message delay) and sent times, 0 until the receipt is known
+    """
+    def __init__(self):
+        self.events = array("l")
+        self.receivers = array("l")
+        self.receives = array("l")
+        self.offsets = array("l")
+        # Slots of records waiting for a receipt, a queue per recipient in
+        # order of sending, messages of one channel are received in the same
+        # order
+        self._waiting = {}
+        # Count of records forgotten by drop, slots keep counting from 0
+        self._dropped = 0
+    
+    def __len__(self):
+        return len(self.events)
+    
+    def add(self, position, receiver, received_time=None, offset=0):
+        """ Stores a new record and returns its slot
+        
+            Arguments:
+            position -- position of the send event within the data list
+            receiver -- a recipient of the message
+            received_time -- the received time if the receipt is already
+                             known, otherwise the record waits for it
+            offset -- the offset of a known receipt (see fill)
+        """
+        slot = self._dropped + len(self.events)
+        self.events.append(position)
+        self.receivers.append(receiver)
+        if received_time is not None:
+            self.receives.append(received_time)
+            self.offsets.append(offset)
+            return slot
+        self.receives.append(0)
+        self.offsets.append(0)
+        waiting = self._waiting.get(receiver)
+        if waiting is None:
+            waiting = self._waiting[receiver] = deque()
+        waiting.append(slot)
+        return slot
+    
+    def fill(self, receiver, received_time, offset):
+        """ Fills the receipt of the oldest message waiting for the receiver
+            and returns its slot
+        """
+        slot = self._waiting[receiver].popleft()
+        self.receives[slot - self._dropped] = received_time
+        self.offsets[slot - self._dropped] = offset
+        return slot
+    
+    def count(self):
+        """ Returns the count of records including the dropped ones """
+        return self._dropped + len(self.events)
+    
+    def waiting_counts(self):
+        """ Returns counts of records waiting for a receipt by recipient """
+        return dict((receiver, len(waiting)) for receiver, waiting 
+                    in self._waiting.iteritems())
+    
+    def waiting_records(self):
+        """ Returns (position, receiver) of records waiting for a receipt
+            in order of sending
+        """
+        slots = sorted(slot for waiting in self._waiting.itervalues()
+                       for slot in waiting)
+        return [ (self.events[slot - self._dropped],
+                  self.receivers[slot - self._dropped]) for slot in slots ]
+    
+    def __getstate__(self):
+        return (self.events.tostring(), self.receivers.tostring(),
+                self.receives.tostring(), self.offsets.tostring(),
+                dict((receiver, list(waiting)) for receiver, waiting
+                     in self._waiting.iteritems()),
+                self._dropped)
+    
+    def __setstate__(self, state):
+        self.__init__()
+        for column, data in zip((self.events, self.receivers, self.receives,
+                                 self.offsets), state[:4]):
+            column.fromstring(data)
+        self._waiting = dict((receiver, deque(waiting)) for receiver, waiting
+                             in state[4].iteritems())
+        self._dropped = state[5]
+    
+    def first_waiting(self):
+        """ Returns the position of the first send event waiting for
+            a receipt, None if there is no such event
+        """
+        slots = [ waiting[0] for waiting in self._waiting.itervalues()
+                  if waiting ]
+        if not slots:
+            return None
+        return self.events[min(slots) - self._dropped]
+    
+    def drop(self, position):
+        """ Forgets records of send events before the position """
+        count = bisect_left(self.events, position)
+        del self.events[:count]
+        del self.receivers[:count]
+        del self.receives[:count]
+        del self.offsets[:count]
+        self._dropped += count
+    
+    def limits(self, count, base=0):
+        """ Returns the smallest offset of every event of the data list, 
+            the maximum of int64 for events other than send events
+        
+            Arguments:
+            count -- count of events from the start of the data list
+            base -- position of the first event of the data list
+        """
+        limits = np.empty(count, dtype=np.int64)
+        limits.fill(np.iinfo(np.int64).max)
+        positions = np.frombuffer(self.events, dtype=np.int_) - base
+        inside = positions < count
+        np.minimum.at(limits, positions[inside],
+                      np.frombuffer(self.offsets, dtype=np.int_)[inside])
+        return limits
@@ -0,0 +1,474 @@
+#
+#    Copyright (C) 2012-2016 Stanislav Bohm,
+#                            Martin Surkovsky,
+#                            Tomas Panoc
+#
+#    THIS FILE IS MODIFIED VARIANT OF ORIGINAL TRACELOG.PY FROM KAIRA.
+#    IT WAS MODIFIED FOR EDUCATIONAL PURPOSES AND YOU MAY USE AND SHARE IT
+#    FOR FREE.
+#
+#    Kaira is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Kaira is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Kaira.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import struct
+import os
+import mmap
+from traceindex import TraceIndex, cache_key, load_index, save_index
+
+zero_char = chr(0)
+
+def read_data(file_name, use_mmap=False):
+    """ Returns content of a file, as a read-only memory map if use_mmap is
+        True (data are then paged in from the file on demand)
+    """
+    with open(file_name, "rb") as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+class Trace:
+
+    struct_basic = struct.Struct("<Q")
+    struct_transition_fired = struct.Struct("<Qi")
+    struct_spawn = struct.Struct("<Qi")
+    struct_send = struct.Struct("<QQii")
+    struct_receive = struct.Struct("<Qi")
+
+    struct_token_4 = struct.Struct("<Li")
+    struct_token_8 = struct.Struct("<Qi")
+
+    struct_int = struct.Struct("<i")
+    struct_double = struct.Struct("<d")
+
+    def __init__(self, data, process_id, pointer_size):
+        self.data = data
+        self.pointer = 0
+        self.process_id = process_id
+        self.time_offset = 0
+        self.pointer_size = pointer_size
+        if pointer_size == 4:
+            self.struct_token = self.struct_token_4
+        elif pointer_size == 8:
+            self.struct_token = self.struct_token_8
+        else:
+            Exception("Invalid pointer size")
+        self.info = self._read_header()
+        self.header_size = self.pointer
+        self.index = None
+        # Path of the trace file whose index is cached next to it, or None
+        self.index_cache = None
+        # Sizes of tagged values including tags, skipped without decoding
+        # when nobody consumes them, None for a NUL-terminated string
+        token_size = 1 + self.struct_token.size
+        self._added_sizes = { "t": token_size, "i": 5, "d": 9, "s": None }
+        self._function_sizes = { "r": token_size, "i": 5, "d": 9, "s": None }
+
+    def build_index(self):
+        """ Scans all events once and stores their positions, types, times
+            and peers into self.index (see TraceIndex). If index_cache is set,
+            a valid cached index is loaded instead and a new one is cached.
+        """
+        if self.index_cache is None:
+            self.index = TraceIndex(self.data, self.header_size,
+                                    self.pointer_size)
+            return self.index
+        key = cache_key(self.index_cache)
+        self.index = load_index(self.index_cache, key, self.pointer_size,
+                                self.header_size,
+                                isinstance(self.data, mmap.mmap))
+        if self.index is None:
+            self.index = TraceIndex(self.data, self.header_size,
+                                    self.pointer_size)
+            save_index(self.index_cache, key, self.index, self.pointer_size,
+                       self.header_size)
+        return self.index
+
+    def get_init_time(self):
+        s = self.info.get("inittime")
+        if s is not None:
+            return int(s)
+        else:
+            return 0
+
+    def is_next_event_visible(self):
+        t = self.data[self.pointer]
+        return t != "I" and t != "M" and t != "N"
+
+    def get_next_event_name(self):
+        """ Return name of event as 5-character string """
+        t = self.data[self.pointer]
+        if t == "T":
+            return "Fire "
+        elif t == "F":
+            return "Fin  "
+        elif t == "M":
+            return "Send "
+        elif t == "N":
+            return "MSend"
+        elif t == "R":
+            return "Recv "
+        elif t == "S":
+            return "Spawn"
+        elif t == "I":
+            return "Idle "
+        elif t == "H" or t == "Q": # "H" for backward compatability
+            return "Quit "
+
+    def process_event(self, runinstance=None):
+        t = self.data[self.pointer]
+        self.pointer += 1
+        if t != "Q":
+            # A quit event is stored by _process_event_quit
+            self._extra_event(t)
+        if runinstance is not None:
+            runinstance.pre_event()
+        process = self._event_processors.get(t)
+        if process is None:
+            raise Exception("Invalid event type '{0}/{1}' (pointer={2}, process={3})"
+                                .format(t, ord(t), hex(self.pointer), self.process_id))
+        return process(self, runinstance)
+
+    def is_pointer_at_end(self):
+        return self.pointer >= len(self.data)
+
+    def process_tokens_add(self, runinstance, send_time=0):
+        place_id = None
+        token_pointer = None
+        values = []
+        pointer1 = self.pointer
+        extra = self._extra_value()
+        if runinstance is None:
+            self._skip_values(self._added_sizes, True)
+            self._extra_tokens_add(pointer1, extra, None)
+            return
+        while not self.is_pointer_at_end():
+            t = self.data[self.pointer]
+            if t == "t":
+                if  runinstance is not None and place_id is not None:
+                    runinstance.add_token(place_id, token_pointer, values, send_time)
+                values = []
+                self.pointer += 1
+                token_pointer, place_id = self._read_struct_token()
+            elif t == "i":
+                self.pointer += 1
+                value = self._read_struct_int()
+                values.append(value)
+            elif t == "d":
+                self.pointer += 1
+                value = self._read_struct_double()
+                values.append(value)
+            elif t == "s":
+                self.pointer += 1
+                value = self._read_cstring()
+                values.append(value)
+            elif t == "M":
+                self.pointer += 1
+                self._process_event_send(runinstance)
+            else:
+                if runinstance is not None and place_id is not None and token_pointer is not None:
+                    runinstance.add_token(place_id, token_pointer, values, send_time)
+                break
+
+        if runinstance is not None and self.is_pointer_at_end() and place_id is not None:
+            runinstance.add_token(place_id, token_pointer, values, send_time)
+        
+        self._extra_tokens_add(pointer1, extra, values)
+        
+        
+    def process_tokens_remove(self, runinstance):
+        while not self.is_pointer_at_end():
+            t = self.data[self.pointer]
+            if t == "r":
+                self.pointer += 1
+                token_pointer, place_id = self._read_struct_token()
+                if runinstance is not None:
+                    runinstance.remove_token(place_id, token_pointer)
+            elif runinstance is not None and t == "M":
+                self.pointer += 1
+                self._process_event_send(runinstance)
+            else:
+                break
+
+    def get_next_event_time(self):
+        if self.is_pointer_at_end():
+            return None
+        else:
+            return self.struct_basic.unpack_from(self.data, self.pointer + 1)[0] + \
+                   self.time_offset
+
+    def _read_header(self):
+        info = {}
+        while True:
+            key = self._read_cstring()
+            value = self._read_cstring()
+            if key == "" and value == "":
+                break
+            info[key] = value
+
+        if "KairaThreadTrace" not in info or info["KairaThreadTrace"] != "1":
+            raise Exception("Invalid format or version of KairaThreadTrace")
+        return info
+
+    def _read_struct_transition_fired(self):
+        values = self.struct_transition_fired.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_transition_fired.size
+        return values
+
+    def _read_struct_transition_finished(self):
+        values = self.struct_basic.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_basic.size
+        return values
+
+    def _read_struct_receive(self):
+        values = self.struct_receive.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_receive.size
+        return values
+
+    def _read_struct_send(self):
+        time, size, edge_id, count = self.struct_send.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_send.size
+        values = [ self._read_struct_int() for i in xrange(count) ]
+        return (time, size, edge_id, values)
+
+    def _read_struct_spawn(self):
+        values = self.struct_spawn.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_spawn.size
+        return values
+
+    def _read_struct_quit(self):
+        values = self.struct_basic.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_basic.size
+        return values
+
+    def _process_end(self, runinstance):
+        t = self.data[self.pointer]
+        if t != "X":
+            return
+        self._extra_event(t)
+        self.pointer += 1
+        pointer1 = self.pointer
+        values = self.struct_basic.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_basic.size
+        self._extra_time(values[0], pointer1)
+        if runinstance is not None:
+            runinstance.event_end(self.process_id, values[0] + self.time_offset)
+
+    def _process_event_transition_fired(self, runinstance):
+        ptr = self.pointer
+        time, transition_id = self._read_struct_transition_fired()
+        pointer1 = self.pointer
+        values = self._read_transition_trace_function_data(
+                                                    runinstance is not None)
+        pointer2 = self.pointer
+        self._extra_time(time, ptr)
+        
+        if runinstance is not None:
+            self.pointer = pointer1
+            runinstance.transition_fired(self.process_id,
+                                         time + self.time_offset,
+                                         transition_id,
+                                         values)
+            self.process_tokens_remove(runinstance)
+            self.pointer = pointer2
+            
+        self._process_event_quit(runinstance)
+        self.process_tokens_add(runinstance)
+        self._process_end(runinstance)
+
+    def _process_event_transition_finished(self, runinstance):
+        pointer1 = self.pointer
+        time = self._read_struct_transition_finished()[0]
+        self._extra_time(time, pointer1)
+        if runinstance is not None:
+            runinstance.transition_finished(self.process_id,
+                                            time + self.time_offset)
+        self._process_event_quit(runinstance)
+        self.process_tokens_add(runinstance)
+        self._process_end(runinstance)
+
+    def _process_event_send(self, runinstance):
+        self._extra_event("M")
+        pointer1 = self.pointer
+        time, size, edge_id, target_ids = self._read_struct_send()
+        extra = self._extra_time(time, pointer1)
+        for target_id in target_ids:
+            self._extra_event_send(extra, target_id)
+            if runinstance is not None:
+                runinstance.event_send(self.process_id,
+                                       time + self.time_offset,
+                                       target_id,
+                                       size,
+                                       edge_id)
+
+    def _process_event_spawn(self, runinstance):
+        pointer1 = self.pointer
+        time, net_id = self._read_struct_spawn()
+        self._extra_time(time, pointer1)
+        if runinstance is not None:
+            runinstance.event_spawn(self.process_id,
+                                    time + self.time_offset,
+                                    net_id)
+        self.process_tokens_add(runinstance)
+
+    def _process_event_quit(self, runinstance):
+        t = self.data[self.pointer]
+        if t != "Q":
+            return
+        self._extra_event(t)
+        self.pointer += 1
+        pointer1 = self.pointer
+        time = self._read_struct_quit()[0]
+        self._extra_time(time, pointer1)
+        if runinstance is not None:
+            runinstance.event_quit(self.process_id,
+                                   time + self.time_offset)
+
+    def _process_event_receive(self, runinstance):
+        pointer1 = self.pointer
+        time, origin_id = self._read_struct_receive()
+        send_time = 0
+        self._extra_time(time, pointer1, True, origin_id)
+        if runinstance is not None:
+            send_time = runinstance.event_receive(
+                            self.process_id,
+                            time + self.time_offset,
+                            origin_id
+                        ) or 1
+        
+
+        self.process_tokens_add(runinstance, send_time)
+        self._process_end(runinstance)
+
+    def _process_event_untraced_quit(self, runinstance):
+        # This is called only when transition that call ctx.quit is not traced
+        self.pointer -= 1 # _process_event_quit expect the pointer at "Q"
+        self._process_event_quit(runinstance)
+
+    def _process_event_idle(self, runinstance):
+        pointer1 = self.pointer
+        time = self._read_struct_quit()[0]
+        self._extra_time(time, pointer1)
+        if runinstance is not None:
+            runinstance.event_idle(self.process_id,
+                                   time + self.time_offset)
+
+    def _read_struct_token(self):
+        values = self.struct_token.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_token.size
+        return values
+
+    def _read_struct_int(self):
+        value = self.struct_int.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_int.size
+        return value[0]
+
+    def _read_struct_double(self):
+        value = self.struct_double.unpack_from(self.data, self.pointer)
+        self.pointer += self.struct_double.size
+        return value[0]
+
+    def _read_cstring(self):
+        start = self.pointer
+        end = self._find_zero(start)
+        self.pointer = end + 1
+        return self.data[start:end]
+
+    def _find_zero(self, start):
+        end = self.data.find(zero_char, start)
+        if end < 0:
+            raise Exception("Unterminated string (pointer={0}, process={1})"
+                                .format(hex(start), self.process_id))
+        return end
+
+    def _skip_values(self, sizes, sends=False):
+        """ Moves the pointer behind tagged values without decoding them
+
+            Arguments:
+            sizes -- tag -> size of a value including the tag, None for
+                     a NUL-terminated string
+            sends -- if True, send events among the values are processed
+        """
+        data = self.data
+        end = len(data)
+        pointer = self.pointer
+        while pointer < end:
+            t = data[pointer]
+            if t in sizes:
+                size = sizes[t]
+                if size is None:
+                    pointer = self._find_zero(pointer + 1) + 1
+                else:
+                    pointer += size
+            elif sends and t == "M":
+                self.pointer = pointer + 1
+                self._process_event_send(None)
+                pointer = self.pointer
+            else:
+                break
+        self.pointer = pointer
+
+    def _read_transition_trace_function_data(self, decode=True):
+        """ Returns values of a fired transition, if decode is False, they
+            are only skipped and None is returned
+        """
+        if not decode:
+            self._skip_values(self._function_sizes)
+            return None
+        values = []
+        while not self.is_pointer_at_end():
+            t = self.data[self.pointer]
+            if t == "r":
+                self.pointer += 1
+                self._read_struct_token()
+            elif t == "i":
+                self.pointer += 1
+                value = self._read_struct_int()
+                values.append(value)
+            elif t == "d":
+                self.pointer += 1
+                value = self._read_struct_double()
+                values.append(value)
+            elif t == "s":
+                self.pointer += 1
+                value = self._read_cstring()
+                values.append(value)
+            else:
+                break
+        return values
+
+    def _extra_event(self, event):
+        """ Reserved for extending the behavior in child classes (SyncedTrace)"""
+        pass
+    def _extra_time(self, time, pointer, receive=False, origin_id=None):
+        """ Reserved for extending the behavior in child classes (SyncedTrace)"""
+        return None
+    def _extra_event_send(self, time, target_id):
+        """ Reserved for extending the behavior in child classes (SyncedTrace)"""
+        pass
+    def _extra_tokens_add(self, pointer, extra, values):
+        """ Reserved for extending the behavior in child classes (SyncedTrace),
+            values are None if they were skipped without decoding """
+        pass
+    def _extra_value(self):
+        """ Reserved for extending the behavior in child classes (SyncedTrace)"""
+        return None
+
+    # Event tags -> functions processing the events, looked up by process_event
+    _event_processors = { "T": _process_event_transition_fired,
+                          "F": _process_event_transition_finished,
+                          "R": _process_event_receive,
+                          "S": _process_event_spawn,
+                          "I": _process_event_idle,
+                          "Q": _process_event_untraced_quit }
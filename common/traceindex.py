@@ -0,0 +1,336 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import hashlib
+import mmap
+import os
+import struct
+import numpy as np
+from array import array
+
+zero_char = chr(0)
+
+struct_int = struct.Struct("<i")
+
+# Sizes of the fixed part following a tag character, token tags ("t", "r")
+# depend on the pointer size and are added in TraceIndex.__init__
+EVENT_SIZES = { "T": 12, "F": 8, "R": 12, "S": 12, "I": 8, "Q": 8, "X": 8 }
+VALUE_SIZES = { "i": 4, "d": 8 }
+
+# A send event ("M") consists of time, size, edge id and count of recipients,
+# followed by count * int
+SEND_SIZE = 24
+SEND_COUNT_POSITION = 21
+
+# Number of events processed at once by the vectorized gathering
+GATHER_CHUNK = 1 << 20
+
+# Number of events converted into lists at once by IndexCursor
+CURSOR_CHUNK = 1 << 14
+
+# An index cache is a file next to the trace, a header followed by columns
+# offsets (int64), times (int64), peers (int32), targets (int32) and types
+# (uint8). The header holds magic, version, pointer size and header size of
+# the trace, size and mtime [ns] of the trace file, counts of events and of
+# targets and a digest of the beginning and of the end of the trace file.
+CACHE_SUFFIX = ".index"
+CACHE_MAGIC = "KTTINDEX"
+CACHE_VERSION = 1
+struct_cache = struct.Struct("<8sIIQQqQQ20s4x")
+CACHE_HASHED = 1 << 16
+
+
+class TraceIndex(object):
+    """ Positions, types, times and peers of all events of one *.ktt file,
+        obtained by a single scan of its data.
+
+        Attributes:
+        offsets -- positions of events' type characters within the data
+        types -- type characters of events as numbers (ord)
+        times -- raw (not synchronized) timestamps of events
+        peers -- id of the sender for a receive event ("R"), number of
+                 recipients for a send event ("M"), -1 for other events
+        targets -- recipients of all send events in order of the events
+    """
+
+    def __init__(self, data, start, pointer_size):
+        """ Scans the data and builds the index
+
+            Arguments:
+            data -- content of a process's *.ktt file
+            start -- position of the first event (end of the header)
+            pointer_size -- 4 or 8, type of binary data within the *.ktt file
+        """
+        sizes = dict(EVENT_SIZES)
+        sizes.update(VALUE_SIZES)
+        sizes["t"] = sizes["r"] = pointer_size + 4
+
+        self.offsets = _scan(data, start, sizes)
+        raw = np.frombuffer(data, dtype=np.uint8)
+        self.types = raw[self.offsets]
+        self.times = _gather(raw, self.offsets + 1, "<u8").astype(np.int64)
+
+        self.peers = np.empty(len(self.offsets), dtype=np.int32)
+        self.peers.fill(-1)
+        receives = self.types == ord("R")
+        self.peers[receives] = _gather(raw, self.offsets[receives] + 9, "<i4")
+        sends = self.types == ord("M")
+        counts = _gather(raw, self.offsets[sends] + SEND_COUNT_POSITION, "<i4")
+        self.peers[sends] = counts
+
+        # Positions of recipient ids, each send contributes with count of them
+        counts = counts.astype(np.int64)
+        firsts = np.repeat(self.offsets[sends] + SEND_SIZE + 1, counts)
+        order = np.arange(counts.sum(), dtype=np.int64) - \
+                np.repeat(np.cumsum(counts) - counts, counts)
+        self.targets = _gather(raw, firsts + 4 * order, "<i4")
+        self._target_starts = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def positions(self, event_types):
+        """ Returns positions of all events of the given types
+
+            Arguments:
+            event_types -- string of type characters, e.g. "MR"
+        """
+        codes = np.frombuffer(event_types, dtype=np.uint8)
+        return np.flatnonzero(np.in1d(self.types, codes))
+
+    def target_starts(self):
+        """ Returns positions of the first recipient of every event within
+            targets, events other than send events have no recipients
+        """
+        if self._target_starts is None:
+            counts = np.where(self.types == ord("M"), self.peers, 0)
+            self._target_starts = np.cumsum(counts, dtype=np.int64) - counts
+        return self._target_starts
+
+    def send_targets(self, i):
+        """ Returns recipients of the i-th event, empty for non-send events """
+        start = self.target_starts()[i]
+        if self.types[i] != ord("M"):
+            return self.targets[start:start]
+        return self.targets[start : start + self.peers[i]]
+
+
+class IndexCursor(object):
+    """ Walks events of a TraceIndex forward. Columns are converted into
+        lists a chunk at a time, so an event is read without a search and
+        without numpy scalar access.
+
+        Attributes:
+        index -- the TraceIndex
+        position -- ordinal of the current event within the index
+        start -- ordinal of the first event of the chunk
+        types -- type characters of events of the chunk (a string)
+        times, peers -- lists of raw times and peers of events of the chunk
+        offsets -- list of positions of events of the chunk followed by
+                   the position of the event behind the chunk (if any)
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.position = 0
+        self._load(0)
+
+    def _load(self, start):
+        """ Converts the chunk of events from the start ordinal """
+        index = self.index
+        end = start + CURSOR_CHUNK
+        self.start = start
+        self.types = index.types[start:end].tostring()
+        self.times = index.times[start:end].tolist()
+        self.offsets = index.offsets[start : end + 1].tolist()
+        self.peers = index.peers[start:end].tolist()
+        starts = index.target_starts()[start:end]
+        if len(starts) > 0:
+            first = int(starts[0])
+            self._targets = index.targets[first : int(starts[-1]) +
+                                          max(self.peers[-1], 0)].tolist()
+            self._target_starts = (starts - first).tolist()
+        else:
+            self._targets = self._target_starts = []
+
+    def seek(self, pointer):
+        """ Moves to the event starting at the pointer, a pointer behind
+            the last event moves behind the index
+        """
+        i = self.position - self.start
+        if i < len(self.offsets) and self.offsets[i] == pointer and \
+                i < len(self.types):
+            return
+        self.move(int(np.searchsorted(self.index.offsets, pointer)))
+
+    def move(self, position):
+        """ Moves to the event of the ordinal position """
+        self.position = position
+        if not 0 <= position - self.start < len(self.types) and \
+                position < len(self.index):
+            self._load(position)
+
+    def sender(self):
+        """ Returns the id of the sender if the current event is a receive
+            event, otherwise None
+        """
+        i = self.position - self.start
+        if i < len(self.types) and self.types[i] == "R":
+            return self.peers[i]
+        return None
+
+    def run_end(self):
+        """ Returns the ordinal of the first receive event from the current
+            event on, runs end at the end of the chunk at the latest
+        """
+        i = self.types.find("R", self.position - self.start)
+        if i == -1:
+            i = len(self.types)
+        return self.start + i
+
+    def targets(self, i):
+        """ Returns recipients of the i-th event of the chunk """
+        if self.types[i] != "M":
+            return []
+        start = self._target_starts[i]
+        return self._targets[start : start + self.peers[i]]
+
+    def pointer(self, end):
+        """ Returns the position of the current event, the end if the cursor
+            is behind the last event
+        """
+        i = self.position - self.start
+        if 0 <= i < len(self.offsets):
+            return self.offsets[i]
+        return end
+
+
+def _scan(data, pointer, sizes):
+    """ Walks through the tags of the data and returns positions of events """
+    offsets = array("l")
+    append = offsets.append
+    find = data.find
+    unpack_from = struct_int.unpack_from
+    end = len(data)
+    while pointer < end:
+        t = data[pointer]
+        if t in EVENT_SIZES:
+            append(pointer)
+            pointer += sizes[t] + 1
+        elif t == "s":
+            pointer = find(zero_char, pointer + 1)
+            if pointer == -1:
+                raise Exception("Unterminated string in trace data")
+            pointer += 1
+        elif t == "M":
+            append(pointer)
+            count = unpack_from(data, pointer + SEND_COUNT_POSITION)[0]
+            pointer += SEND_SIZE + 4 * count + 1
+        elif t in sizes:
+            pointer += sizes[t] + 1
+        else:
+            raise Exception("Invalid tag '{0}/{1}' (pointer={2})"
+                            .format(t, ord(t), hex(pointer)))
+    if pointer > end:
+        raise Exception("Truncated trace data")
+    return np.frombuffer(offsets, dtype=np.int_).astype(np.int64)
+
+def _gather(raw, positions, dtype):
+    """ Reads values of the dtype stored at the positions of the raw bytes """
+    dtype = np.dtype(dtype)
+    result = np.empty(len(positions), dtype=dtype)
+    steps = np.arange(dtype.itemsize, dtype=np.int64)
+    for i in xrange(0, len(positions), GATHER_CHUNK):
+        chunk = positions[i : i + GATHER_CHUNK]
+        result[i : i + len(chunk)] = \
+            raw[chunk[:, np.newaxis] + steps].view(dtype).ravel()
+    return result
+
+def cache_key(filename):
+    """ Returns (size, mtime [ns], digest) identifying the content of a trace
+        file, only the beginning and the end of the file are hashed
+    """
+    stat = os.stat(filename)
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        digest.update(f.read(CACHE_HASHED))
+        if stat.st_size > CACHE_HASHED:
+            f.seek(max(CACHE_HASHED, stat.st_size - CACHE_HASHED))
+            digest.update(f.read())
+    return (stat.st_size, int(stat.st_mtime * 10 ** 9), digest.digest())
+
+def load_index(filename, key, pointer_size, header_size, use_mmap=False):
+    """ Returns the index of a trace file stored in its cache file by one
+        read (or memory map), None if the cache is missing or does not
+        belong to the content of the trace file
+
+        Arguments:
+        filename -- path of the trace file
+        key -- cache_key of the trace file
+        pointer_size -- 4 or 8, type of binary data within the *.ktt file
+        header_size -- position of the first event of the trace
+        use_mmap -- if True, columns are mapped from the cache file
+    """
+    try:
+        with open(filename + CACHE_SUFFIX, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < struct_cache.size:
+                return None
+            if use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # An array, unlike a string, keeps the columns aligned
+                data = np.fromfile(f, dtype=np.uint8)
+    except (IOError, OSError):
+        return None
+    magic, version, cached_pointer_size, cached_header_size, trace_size, \
+        mtime, count, target_count, digest = struct_cache.unpack_from(data)
+    if (magic, version, cached_pointer_size, cached_header_size) != \
+            (CACHE_MAGIC, CACHE_VERSION, pointer_size, header_size) or \
+            (trace_size, mtime, digest) != key or \
+            size != struct_cache.size + 21 * count + 4 * target_count:
+        return None
+
+    index = TraceIndex.__new__(TraceIndex)
+    position = struct_cache.size
+    columns = []
+    for dtype, length in ((np.int64, count), (np.int64, count),
+                          (np.int32, count), (np.int32, target_count),
+                          (np.uint8, count)):
+        columns.append(np.frombuffer(data, dtype=dtype, count=length,
+                                     offset=position))
+        position += length * np.dtype(dtype).itemsize
+    index.offsets, index.times, index.peers, index.targets, index.types = \
+        columns
+    index._target_starts = None
+    return index
+
+def save_index(filename, key, index, pointer_size, header_size):
+    """ Stores the index of a trace file into its cache file, the cache is
+        skipped if the file cannot be written (e.g. a read-only directory)
+
+        Arguments:
+        filename -- path of the trace file
+        key -- cache_key of the trace file
+        index -- the TraceIndex of the trace
+        pointer_size -- 4 or 8, type of binary data within the *.ktt file
+        header_size -- position of the first event of the trace
+    """
+    trace_size, mtime, digest = key
+    header = struct_cache.pack(CACHE_MAGIC, CACHE_VERSION, pointer_size,
+                               header_size, trace_size, mtime,
+                               len(index.offsets), len(index.targets), digest)
+    # Written aside and renamed, a concurrent reader never sees a part of it
+    temporary = "{0}{1}.{2}".format(filename, CACHE_SUFFIX, os.getpid())
+    try:
+        with open(temporary, "wb") as f:
+            f.write(header)
+            for column, dtype in ((index.offsets, "<i8"), (index.times, "<i8"),
+                                  (index.peers, "<i4"), (index.targets, "<i4"),
+                                  (index.types, "u1")):
+                f.write(np.asarray(column, dtype=dtype).tostring())
+        os.rename(temporary, filename + CACHE_SUFFIX)
+    except (IOError, OSError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
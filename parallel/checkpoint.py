@@ -0,0 +1,115 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import cPickle as pickle
+import os
+import os.path
+import time
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpointer(object):
+    """ Stores states of the forward pass of traces (see
+        ParallelSyncedTrace.checkpoint_state) into a directory periodically,
+        one file per trace. Every trace is stored independently of other
+        traces and processes, the synchronization waits for nobody; states
+        are made consistent when they are restored (see resume).
+
+        Attributes:
+        directory -- directory of checkpoint files
+        interval -- minimal time between two checkpoints [s]
+        meta -- settings of the run, a checkpoint is restored only by a run
+                with the same settings
+    """
+
+    def __init__(self, directory, interval, meta):
+        self.directory = directory
+        self.interval = interval
+        self.meta = meta
+        self._last = time.time()
+
+    def filename(self, trace_id):
+        return os.path.join(self.directory, "trace-{0}.ckpt".format(trace_id))
+
+    def tick(self, traces):
+        """ Stores states of the traces if the interval has elapsed since
+            the previous checkpoint
+        """
+        now = time.time()
+        if now - self._last < self.interval:
+            return
+        for trace in traces:
+            self.save(trace)
+        self._last = time.time()
+
+    def save(self, trace):
+        """ Stores the state of the trace, the previous checkpoint is replaced
+            only once the new one is complete. If the new one cannot be
+            written, its temporary file is deleted and the error is raised.
+        """
+        filename = self.filename(trace.process_id)
+        temp = filename + ".tmp"
+        try:
+            with open(temp, "wb") as f:
+                pickle.dump((CHECKPOINT_VERSION, self.meta,
+                             trace.checkpoint_state()), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, filename)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def load(self, trace):
+        """ Restores the state of the trace from its checkpoint, returns False
+            if there is no checkpoint of the trace
+        """
+        filename = self.filename(trace.process_id)
+        if not os.path.exists(filename):
+            return False
+        with open(filename, "rb") as f:
+            version, meta, state = pickle.load(f)
+        if version != CHECKPOINT_VERSION or meta != self.meta:
+            raise Exception("Checkpoint {0} was taken with other settings"
+                            .format(filename))
+        trace.restore_state(state)
+        return True
+
+    def remove(self, traces):
+        """ Deletes checkpoints of the traces with temporary files left by
+            interrupted saves
+        """
+        for trace in traces:
+            filename = self.filename(trace.process_id)
+            for path in (filename, filename + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def resume(comm, traces, process_count):
+    """ Continues the exchange of times of restored traces, a collective
+        operation (see ParallelSyncedTrace.resume). Traces without
+        a checkpoint start from the beginning.
+
+        Arguments:
+        comm -- MPI communicator
+        traces -- ParallelSyncedTraces of this process
+        process_count -- count of all traces
+    """
+    counts = [None] * process_count
+    for rank_counts in comm.allgather([ (trace.process_id,
+                                         trace.channel_counts())
+                                        for trace in traces ]):
+        for trace_id, trace_counts in rank_counts:
+            counts[trace_id] = trace_counts
+    receipts = {}
+    for trace in traces:
+        for origin_id, times in trace.resumed_receipts(counts).iteritems():
+            receipts.setdefault(origin_id, {})[trace.process_id] = times
+    gathered = {}
+    for rank_receipts in comm.allgather(receipts):
+        for origin_id, times in rank_receipts.iteritems():
+            gathered.setdefault(origin_id, {}).update(times)
+    for trace in traces:
+        trace.resume(counts, gathered.get(trace.process_id, {}))
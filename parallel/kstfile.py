@@ -0,0 +1,56 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import numpy as np
+from mpi4py import MPI
+
+_EMPTY = np.empty(0, dtype=np.uint8)
+
+
+def write_kst(communicator, filename, tracelog, pointer_size, process_count,
+              traces):
+    """ Writes synchronized traces of all processes into one *.kst file of
+        the same layout as the sequential version exports. Sizes of traces
+        are gathered by all processes, so each of them knows where its traces
+        start, rank 0 writes the header and the rest of the *.kth, every
+        process writes its traces by collective writes. A collective operation.
+
+        Arguments:
+        communicator -- MPI communicator
+        filename -- path to the *.kst
+        tracelog -- path to the *.kth
+        pointer_size -- 4 or 8, from the *.kth
+        process_count -- count of all traces
+        traces -- synchronized traces of this process (ParallelSyncedTrace)
+    """
+    rank = communicator.Get_rank()
+    exports = [ (trace.process_id, trace.export_raw()) for trace in traces ]
+    sizes = [0] * process_count
+    for rank_sizes in communicator.allgather([ (process_id, len(data))
+                                               for process_id, data
+                                               in exports ]):
+        for process_id, size in rank_sizes:
+            sizes[process_id] = size
+    header = "{0}\n{1}\n".format(pointer_size, process_count) + \
+             "".join("{0}\n".format(size) for size in sizes)
+    starts = np.cumsum([len(header)] + sizes).tolist()
+    
+    f = MPI.File.Open(communicator, filename,
+                      MPI.MODE_WRONLY | MPI.MODE_CREATE)
+    f.Set_size(0)
+    if rank == 0:
+        f.Write_at(0, [header, MPI.BYTE])
+        with open(tracelog, "rb") as kth:
+            kth.readline()
+            f.Write_at(starts[-1], [kth.read(), MPI.BYTE])
+    # Every process takes part in as many writes as the process having
+    # the most traces, the missing ones are empty
+    rounds = communicator.allreduce(len(exports), op=MPI.MAX)
+    for i in xrange(rounds):
+        if i < len(exports):
+            process_id, data = exports[i]
+            f.Write_at_all(starts[process_id], [data, MPI.BYTE])
+        else:
+            f.Write_at_all(0, [_EMPTY, MPI.BYTE])
+    f.Close()
@@ -1,4 +1,4 @@
-import sys
+import argparse
 import os
 import time as tm
 import os.path
@@ -6,62 +6,294 @@ import tracelog as tr
 from shutil import copyfile
 from mpi4py import MPI
 from paralleltrace import ParallelSyncedTrace
+from transport import Transport, BatchedTransport, TypedTransport, Router, \
+                      DeferredReplies
+from schedule import assign_traces, run_traces
+from kstfile import write_kst
+from stats import Stats, write_summary
+from waits import WaitLog, write_report
+from checkpoint import Checkpointer, resume
+from online import TraceTail, follow
 
 def whoiam(rank, data):
     print "I am {0}. I have {1}.".format(rank, data)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+                description="Synchronizes timestamps of a Kaira tracelog, "
+                            "one MPI process per trace or several traces "
+                            "per MPI process if there are less processes "
+                            "than traces")
+    parser.add_argument("tracelog", help="file path to a *.kth")
+    parser.add_argument("min_event_diff", type=int,
+                        help="minimal event difference [ns]")
+    parser.add_argument("min_msg_delay", type=int,
+                        help="minimum message delay between 2 processes [ns]")
+    parser.add_argument("--index", action="store_true",
+                        help="index the trace in one pass before "
+                             "the synchronization")
+    parser.add_argument("--index-cache", action="store_true",
+                        help="keep the index of every trace in a file next "
+                             "to it and reuse it by later runs, implies "
+                             "--index")
+    parser.add_argument("--mmap", action="store_true",
+                        help="map trace files into memory instead of "
+                             "reading them")
+    parser.add_argument("--inplace-export", action="store_true",
+                        help="write traces straight into the output file "
+                             "instead of joining them in memory")
+    parser.add_argument("--batch-clock", action="store_true",
+                        help="compute times of runs of events between "
+                             "receive events at once")
+    parser.add_argument("--stream", action="store_true",
+                        help="write events out during the synchronization "
+                             "once they are final, events not final yet "
+                             "stay in memory")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="count of send times coalesced into one message "
+                             "per recipient (default 1, no batching)")
+    parser.add_argument("--typed", action="store_true",
+                        help="exchange times as int64 buffers instead of "
+                             "pickled objects")
+    parser.add_argument("--deferred-replies", action="store_true",
+                        help="deliver receive times for the backward "
+                             "amortization by one all-to-all exchange after "
+                             "the forward pass")
+    parser.add_argument("--kst", action="store_true",
+                        help="write one synchronized_trace.kst by collective "
+                             "MPI-IO instead of a folder of traces")
+    parser.add_argument("--balance", choices=("size", "events"),
+                        default="size",
+                        help="weight of a trace for the distribution of "
+                             "traces among processes (default size)")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="store times of phases and counters of all "
+                             "processes reduced to min/avg/max as JSON")
+    parser.add_argument("--waits", metavar="FILE",
+                        help="record blocking waits for sent times and store "
+                             "the longest chains of waits and the most "
+                             "stalled processes as JSON")
+    parser.add_argument("--checkpoint", metavar="DIR",
+                        help="store the state of every trace into the "
+                             "directory periodically, an interrupted run "
+                             "continues from it with --resume")
+    parser.add_argument("--checkpoint-interval", type=float, default=300,
+                        metavar="SECONDS",
+                        help="time between checkpoints of a trace "
+                             "(default 300)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from checkpoints stored in "
+                             "the --checkpoint directory")
+    parser.add_argument("--online", action="store_true",
+                        help="follow trace files still written by a running "
+                             "application and write synchronized events out "
+                             "as they become final, implies --stream")
+    parser.add_argument("--online-timeout", type=float, default=60,
+                        metavar="SECONDS",
+                        help="a followed trace ends when its file has not "
+                             "grown for this time (default 60)")
+    args = parser.parse_args()
+    if args.online:
+        if args.index or args.index_cache or args.batch_clock:
+            parser.error("--online follows growing traces, they cannot be "
+                         "indexed (--index, --index-cache, --batch-clock)")
+        if args.checkpoint or args.deferred_replies:
+            parser.error("--online cannot be combined with --checkpoint or "
+                         "--deferred-replies")
+        args.stream = True
+    if args.stream and args.kst:
+        parser.error("--stream writes a folder of traces, it cannot be "
+                     "combined with --kst")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if args.checkpoint and args.stream:
+        parser.error("--stream writes events out during the "
+                     "synchronization, it cannot be combined with "
+                     "--checkpoint")
+    return args
+
+def trace_weights(comm, filename, pointer_size, process_count, balance, 
+                  use_mmap, index_cache):
+    """ Returns weights of all traces for assign_traces, sizes of files or
+        counts of events counted by processes in parallel
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    if balance == "size":
+        weights = None
+        if rank == 0:
+            weights = [ os.path.getsize(tr.trace_filename(filename, i))
+                        for i in xrange(process_count) ]
+        return comm.bcast(weights, root=0)
+    
+    counts = []
+    for i in xrange(rank, process_count, size):
+        tracedata, tracefile = tr.read_trace(filename, i, use_mmap)
+        trace = tr.Trace(tracedata, i, pointer_size)
+        if index_cache:
+            trace.index_cache = tracefile
+        counts.append(len(trace.build_index()))
+    weights = [None] * process_count
+    for r, rank_counts in enumerate(comm.allgather(counts)):
+        weights[r : process_count : size] = rank_counts
+    return weights
+
 def main():
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     size = comm.Get_size()
     
-    if len(sys.argv) != 4:
-        if rank == 0:
-            print "Missing argument!\nArguments:\n1 - file path to a *.kth\n2 - minimal event difference [ns]\n3 - minimum message delay between 2 processes [ns]"
-        return
+    args = parse_args()
+    stats = Stats()
         
     # Load *.kth and distribute information inside
     if rank == 0:
         exec_start = tm.time()
-        filename = sys.argv[1]
+        filename = args.tracelog
         cleanname = os.path.split(filename)[1]
         path = os.path.split(filename)[0]
         newfolder = "synchronized"
         if path != "":
             newfolder = path + "/" + newfolder
-        if not os.path.exists(newfolder):
-            os.makedirs(newfolder)
-        copyfile(filename, newfolder + "/" + cleanname)
+        if not args.kst:
+            if not os.path.exists(newfolder):
+                os.makedirs(newfolder)
+            copyfile(filename, newfolder + "/" + cleanname)
         data = (tr.read_header(filename), tr.trim_filename_suffix(filename), 
                 newfolder)
     else:
         data = None
     data = comm.bcast(data, root = 0)
-    
-    # Init trace
-    tracedata, tracefile = tr.read_trace(data[1], rank)
+    stats.lap("header_broadcast")
+    pointer_size, process_count = data[0]
     newfolder = data[2]
-    trace = ParallelSyncedTrace(tracedata, rank, data[0], int(sys.argv[2]), 
-                                int(sys.argv[3]), True, True, comm)
+    
+    # Distributes traces among processes, process i synchronizes trace i if 
+    # counts are equal
+    if args.online and process_count != size:
+        raise Exception("--online needs one MPI process per trace "
+                        "({0} processes)".format(process_count))
+    if process_count == size:
+        owners = range(size)
+        if args.typed:
+            transports = [ TypedTransport(comm, args.batch_size) ]
+        elif args.batch_size > 1:
+            transports = [ BatchedTransport(comm, args.batch_size) ]
+        else:
+            transports = [ Transport(comm) ]
+    else:
+        owners = assign_traces(trace_weights(comm, data[1], pointer_size,
+                                             process_count, args.balance,
+                                             args.mmap, args.index_cache),
+                               size)
+        router = Router(comm, owners, args.batch_size)
+        transports = [ router.endpoint(i) for i in xrange(process_count)
+                       if owners[i] == rank ]
+    process_ids = [ i for i in xrange(process_count) if owners[i] == rank ]
+    waits = WaitLog() if args.waits else None
+    if args.deferred_replies:
+        deferred = DeferredReplies(comm, owners)
+        transports = [ deferred.endpoint(transport, process_id) for 
+                       process_id, transport in zip(process_ids, transports) ]
+    
+    # Init traces
+    traces = []
+    tracefiles = []
+    tails = []
+    for process_id, transport in zip(process_ids, transports):
+        if args.online:
+            tracefile = tr.trace_filename(data[1], process_id)
+            tails.append(TraceTail(tracefile, pointer_size,
+                                   args.online_timeout))
+            tracedata = tails[-1].wait_header()
+        else:
+            tracedata, tracefile = tr.read_trace(data[1], process_id,
+                                                 args.mmap or args.stream)
+        stream = None
+        if args.stream:
+            stream = (open(newfolder + "/" + os.path.split(tracefile)[1], 
+                           "wb"), 0)
+        traces.append(ParallelSyncedTrace(tracedata, process_id, pointer_size,
+                                          args.min_event_diff, 
+                                          args.min_msg_delay, True, True, comm,
+                                          index=args.index or
+                                                args.index_cache,
+                                          inplace_export=args.inplace_export,
+                                          batch_clock=args.batch_clock,
+                                          stream=stream,
+                                          transport=transport,
+                                          waits=waits,
+                                          index_cache=tracefile if
+                                                args.index_cache else None,
+                                          checkpoint=bool(args.checkpoint)))
+        tracefiles.append(tracefile)
     
     # Sets common reference init time for all traces, the lowest one is chosen
-    init_time = trace.get_init_time()
-    data = init_time
+    init_times = [ trace.get_init_time() for trace in traces ]
+    data = min(init_times) if init_times else None
     data = comm.gather(data, root=0)
     
     if rank == 0:
-        starttime = min(data)
+        starttime = min(t for t in data if t is not None)
     else:
         starttime = None
     
     starttime = comm.bcast(starttime, root=0)
-    trace.time_offset = init_time - starttime
+    for trace, init_time in zip(traces, init_times):
+        trace.time_offset = init_time - starttime
+    stats.lap("read")
     
-    while not trace.is_pointer_at_end():
-        trace.process_event()
+    tick = None
+    if args.checkpoint:
+        if rank == 0 and not os.path.exists(args.checkpoint):
+            os.makedirs(args.checkpoint)
+        comm.barrier()
+        checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval,
+                                    (process_count, args.min_event_diff,
+                                     args.min_msg_delay))
+        tick = lambda: checkpointer.tick(traces)
+        if args.resume:
+            for trace in traces:
+                checkpointer.load(trace)
+            resume(comm, traces, process_count)
+            stats.lap("resume")
+    
+    # Waits for sent times are counted only if stats are stored, it costs
+    # a check whether a time has arrived per receive
+    if args.online:
+        follow(traces[0], tails[0], transports[0])
+    elif process_count == size:
+        trace = traces[0]
+        while not trace.is_pointer_at_end():
+            if args.stats and trace.is_blocked():
+                with stats.phase("receive_wait"):
+                    trace.process_next()
+            else:
+                trace.process_next()
+            if tick is not None:
+                tick()
+    else:
+        run_traces(traces, router.poll, 
+                   stats.timed("receive_wait", router.wait), waits, tick)
+    stats.lap("forward")
+    # Receive times are completed before transports wait for their sends,
+    # a process waiting for the delivery of a large batch would not receive
+    # batches of other processes waiting the same way. Buffered times are
+    # sent first, other processes may still be blocked on them.
+    for transport in transports:
+        transport.flush()
+    if args.deferred_replies:
+        deferred.exchange()
+    for trace in traces:
+        trace.complete_replies()
+    for transport in transports:
+        transport.close()
+    stats.lap("ba_completion")
         
-    trace.do_backward_amortization()
+    for trace in traces:
+        trace.do_backward_amortization()
+    stats.lap("backward")
     
     data = 0
     data = comm.gather(data, root=0)
@@ -69,7 +301,27 @@ def main():
         execution_time = tm.time() - exec_start
         print "Execution time: {0}".format(execution_time)
         
-    trace.export_data(newfolder + "/" + os.path.split(tracefile)[1])
+    if args.kst:
+        write_kst(comm, os.path.join(os.path.split(args.tracelog)[0],
+                                     "synchronized_trace.kst"),
+                  args.tracelog, pointer_size, process_count, traces)
+    else:
+        for trace, tracefile in zip(traces, tracefiles):
+            trace.export_data(newfolder + "/" + os.path.split(tracefile)[1])
+    stats.lap("export")
+    
+    if args.stats:
+        for trace in traces:
+            stats.count_trace(trace)
+        records = comm.gather(stats.record(), root=0)
+        if rank == 0:
+            write_summary(args.stats, records)
+    if args.waits:
+        records = comm.gather(waits.records, root=0)
+        if rank == 0:
+            write_report(args.waits, sum(records, []), owners)
+    if args.checkpoint:
+        checkpointer.remove(traces)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,189 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+""" Synchronizes a tracelog on one machine by worker processes of
+    the multiprocessing module, without MPI. Traces are distributed among
+    workers as by the MPI engine with less processes than traces, times
+    travel between workers in batches through a queue per worker.
+"""
+
+import argparse
+import os
+import os.path
+import time as tm
+import multiprocessing
+import tracelog as tr
+from Queue import Empty
+from shutil import copyfile
+from paralleltrace import ParallelSyncedTrace
+from schedule import assign_traces, run_traces
+from routing import RouterBase
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+                description="Synchronizes timestamps of a Kaira tracelog "
+                            "by worker processes on one machine")
+    parser.add_argument("tracelog", help="file path to a *.kth")
+    parser.add_argument("min_event_diff", type=int,
+                        help="minimal event difference [ns]")
+    parser.add_argument("min_msg_delay", type=int,
+                        help="minimum message delay between 2 processes [ns]")
+    parser.add_argument("--workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="count of worker processes (default count of "
+                             "CPUs, at most count of traces)")
+    parser.add_argument("--index", action="store_true",
+                        help="index the trace in one pass before "
+                             "the synchronization")
+    parser.add_argument("--index-cache", action="store_true",
+                        help="keep the index of every trace in a file next "
+                             "to it and reuse it by later runs, implies "
+                             "--index")
+    parser.add_argument("--mmap", action="store_true",
+                        help="map trace files into memory instead of "
+                             "reading them")
+    parser.add_argument("--inplace-export", action="store_true",
+                        help="write traces straight into the output file "
+                             "instead of joining them in memory")
+    parser.add_argument("--batch-clock", action="store_true",
+                        help="compute times of runs of events between "
+                             "receive events at once")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="count of times coalesced into one message "
+                             "per worker (default 64)")
+    return parser.parse_args()
+
+
+class QueueRouter(RouterBase):
+    """ Delivers times among traces of workers (see RouterBase), the batches
+        for a worker are lists of records put into its inbox.
+
+        Attributes:
+        owners -- owners[trace id] is the worker synchronizing the trace
+        inboxes -- multiprocessing queues of all workers
+        batch_size -- maximum count of records in one batch
+    """
+
+    def __init__(self, worker, owners, inboxes, batch_size):
+        RouterBase.__init__(self, worker, owners, batch_size)
+        self.inboxes = inboxes
+        # worker -> records
+        self._outgoing = {}
+
+    def poll(self):
+        """ Dispatches all batches which have already arrived, does not block
+        """
+        inbox = self.inboxes[self.local_id]
+        while True:
+            try:
+                batch = inbox.get_nowait()
+            except Empty:
+                return
+            self._dispatch(batch)
+
+    def flush(self):
+        for owner, batch in self._outgoing.iteritems():
+            if batch:
+                self._send_batch(owner)
+
+    def _append(self, owner, kind, origin_id, target_id, time):
+        batch = self._outgoing.get(owner)
+        if batch is None:
+            batch = self._outgoing[owner] = []
+        batch.append((kind, origin_id, target_id, time))
+        if len(batch) >= self.batch_size:
+            self._send_batch(owner)
+
+    def _wait_batch(self):
+        self._dispatch(self.inboxes[self.local_id].get())
+
+    def _dispatch(self, batch):
+        deliver = self._deliver
+        for record in batch:
+            deliver(*record)
+
+    def _send_batch(self, owner):
+        self.inboxes[owner].put(self._outgoing[owner])
+        self._outgoing[owner] = []
+
+
+def synchronize(worker, owners, inboxes, args, pointer_size, starttime,
+                newfolder):
+    """ Synchronizes and exports traces of one worker """
+    router = QueueRouter(worker, owners, inboxes, args.batch_size)
+    filename = tr.trim_filename_suffix(args.tracelog)
+    traces = []
+    tracefiles = []
+    for process_id in xrange(len(owners)):
+        if owners[process_id] != worker:
+            continue
+        tracedata, tracefile = tr.read_trace(filename, process_id, args.mmap)
+        trace = ParallelSyncedTrace(tracedata, process_id, pointer_size,
+                                    args.min_event_diff, args.min_msg_delay,
+                                    True, True, None,
+                                    index=args.index or args.index_cache,
+                                    inplace_export=args.inplace_export,
+                                    batch_clock=args.batch_clock,
+                                    transport=router.endpoint(process_id),
+                                    index_cache=tracefile if
+                                        args.index_cache else None)
+        trace.time_offset = trace.get_init_time() - starttime
+        traces.append(trace)
+        tracefiles.append(tracefile)
+    
+    run_traces(traces, router.poll, router.wait)
+    router.close()
+    for trace in traces:
+        trace.do_backward_amortization()
+    for trace, tracefile in zip(traces, tracefiles):
+        trace.export_data(newfolder + "/" + os.path.split(tracefile)[1])
+
+def main():
+    args = parse_args()
+    exec_start = tm.time()
+    
+    filename = args.tracelog
+    path, cleanname = os.path.split(filename)
+    newfolder = "synchronized"
+    if path != "":
+        newfolder = path + "/" + newfolder
+    if not os.path.exists(newfolder):
+        os.makedirs(newfolder)
+    copyfile(filename, newfolder + "/" + cleanname)
+    pointer_size, process_count = tr.read_header(filename)
+    basename = tr.trim_filename_suffix(filename)
+    
+    # Sets common reference init time for all traces, the lowest one is
+    # chosen, traces are only mapped to read their headers
+    starttime = min(tr.Trace(tr.read_trace(basename, i, True)[0], i,
+                             pointer_size).get_init_time()
+                    for i in xrange(process_count))
+    
+    count = max(1, min(args.workers, process_count))
+    owners = assign_traces([ os.path.getsize(tr.trace_filename(basename, i))
+                             for i in xrange(process_count) ], count)
+    inboxes = [ multiprocessing.Queue() for i in xrange(count) ]
+    workers = [ multiprocessing.Process(target=synchronize,
+                                        args=(i, owners, inboxes, args,
+                                              pointer_size, starttime,
+                                              newfolder))
+                for i in xrange(count) ]
+    for worker in workers:
+        worker.start()
+    # Other workers would wait for times of a failed one forever
+    while any(worker.is_alive() for worker in workers):
+        if any(worker.exitcode for worker in workers):
+            for worker in workers:
+                worker.terminate()
+            break
+        workers[0].join(0.1)
+    if any(worker.exitcode for worker in workers):
+        raise Exception("A worker failed, the synchronization is incomplete")
+    
+    execution_time = tm.time() - exec_start
+    print "Execution time: {0}".format(execution_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import mmap
+import os
+import struct
+import time
+from traceindex import EVENT_SIZES, VALUE_SIZES, SEND_SIZE, \
+                       SEND_COUNT_POSITION
+
+struct_int = struct.Struct("<i")
+
+# Seconds between two checks of a trace file which has not grown
+POLL_INTERVAL = 0.1
+
+# Events which never belong to the group of a preceding event, a group
+# (e.g. a fired transition with its quit, tokens, sends and end) is complete
+# once one of them follows it
+GROUP_STARTS = "TFRSI"
+
+zero_char = chr(0)
+
+
+class TraceTail(object):
+    """ A *.ktt file still written by a running process. The file is mapped
+        into memory again whenever it grows. Only complete groups of events
+        are exposed, a group is complete once the next group starts or once
+        the trace ends. A trace ends when its file has not grown for
+        the timeout.
+
+        Attributes:
+        filename -- path of the *.ktt file
+        data -- memory map of the file (or an empty string)
+        end -- end of the complete groups of events within data
+        finished -- True if the trace has ended, end is then the end of
+                    the last complete event
+    """
+
+    def __init__(self, filename, pointer_size, timeout):
+        """ Arguments:
+            filename -- path of the *.ktt file, it may not exist yet
+            pointer_size -- 4 or 8, type of binary data within the file
+            timeout -- seconds without growth after which the trace ends
+        """
+        self.filename = filename
+        self.timeout = timeout
+        self.data = ""
+        self.end = 0
+        self.finished = False
+        self._sizes = dict(EVENT_SIZES)
+        self._sizes.update(VALUE_SIZES)
+        self._sizes["t"] = self._sizes["r"] = pointer_size + 4
+        # Position of the next unscanned tag, None until the header is
+        # complete
+        self._scanned = None
+        self._grown = time.time()
+
+    def wait_header(self):
+        """ Blocks until the header of the trace is written and returns
+            the data
+        """
+        while self._scanned is None:
+            if not self.poll():
+                if self.finished:
+                    raise Exception("No header in trace file {0}"
+                                    .format(self.filename))
+                time.sleep(POLL_INTERVAL)
+        return self.data
+
+    def poll(self):
+        """ Maps the file again if it has grown and finds complete groups of
+            new events. Returns True if the file has grown.
+        """
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if size <= len(self.data):
+            if time.time() - self._grown >= self.timeout:
+                self.finished = True
+                if self._scanned is not None:
+                    self.end = self._scanned
+            return False
+        self._grown = time.time()
+        with open(self.filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._scanned is None:
+            self._scanned = _header_end(self.data)
+            if self._scanned is None:
+                return True
+            self.end = self._scanned
+        self._scan()
+        return True
+
+    def _scan(self):
+        """ Walks through tags of complete events behind the scanned part """
+        data = self.data
+        sizes = self._sizes
+        end = len(data)
+        pointer = self._scanned
+        while pointer < end:
+            t = data[pointer]
+            if t in GROUP_STARTS:
+                self.end = pointer
+            if t == "s":
+                zero = data.find(zero_char, pointer + 1)
+                if zero == -1:
+                    break
+                next_pointer = zero + 1
+            elif t == "M":
+                if pointer + SEND_SIZE + 1 > end:
+                    break
+                count = struct_int.unpack_from(data, pointer +
+                                               SEND_COUNT_POSITION)[0]
+                next_pointer = pointer + SEND_SIZE + 4 * count + 1
+            elif t in sizes:
+                next_pointer = pointer + sizes[t] + 1
+            else:
+                raise Exception("Invalid tag '{0}/{1}' (pointer={2}, file={3})"
+                                .format(t, ord(t), hex(pointer),
+                                        self.filename))
+            if next_pointer > end:
+                break
+            pointer = next_pointer
+        self._scanned = pointer
+
+
+def _header_end(data):
+    """ Returns the position behind the header of the trace (pairs of
+        NUL-terminated key and value ended by an empty pair), None if
+        the header is not complete
+    """
+    pointer = 0
+    while True:
+        key_end = data.find(zero_char, pointer)
+        if key_end == -1:
+            return None
+        value_end = data.find(zero_char, key_end + 1)
+        if value_end == -1:
+            return None
+        if key_end == pointer and value_end == key_end + 1:
+            return value_end + 1
+        pointer = value_end + 1
+
+def follow(trace, tail, transport):
+    """ Synchronizes events of the trace as they are appended to its file
+        until the trace ends. Whenever the trace waits for more data, events
+        which no later correction can change are written out (see
+        ParallelSyncedTrace.flush_stream) and buffered times are sent.
+
+        Arguments:
+        trace -- a streamed ParallelSyncedTrace reading the data of the tail
+        tail -- the TraceTail of the trace file
+        transport -- the transport of the trace
+    """
+    while True:
+        while trace.pointer < tail.end:
+            trace.process_next()
+        trace.flush_stream()
+        transport.flush()
+        if tail.finished:
+            return
+        if tail.poll():
+            trace.data = tail.data
+        else:
+            time.sleep(POLL_INTERVAL)
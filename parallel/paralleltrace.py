@@ -2,232 +2,136 @@
 #    Copyright (C) 2016 Tomas Panoc
 #
 
-import copy 
-from tracelog import Trace
-from Queue import Queue
-from collections import OrderedDict
-from cStringIO import StringIO
+import mmap
+import time as tm
+from collections import Counter, defaultdict, deque
+from synctrace import SyncedTraceBase
 
-MAIN_COMMUNICATION = 1
-BA_COMMUNICATION = 2
-      
-class ParallelSyncedTrace(Trace):
+class ParallelSyncedTrace(SyncedTraceBase):
     
     def __init__(self, data, process_id, pointer_size, minimal_event_diff, \
                                      minimum_msg_delay, \
                                      forward_amort, \
                                      backward_amort, \
-                                     communicator):
+                                     communicator, \
+                                     index=False, \
+                                     inplace_export=False, \
+                                     batch_clock=False, \
+                                     stream=None, \
+                                     transport=None, \
+                                     waits=None, \
+                                     index_cache=None, \
+                                     checkpoint=False):
         """ Synchronizes events of one process.
         
             Arguments:
-            data -- content of a process's *.ktt file
-            process_id -- ID of the process
-            pointer_size -- 4 or 8, type of binary data within the *.ktt file
-            minimal_event_diff -- see the SyncedTraceLog class
-            minimum_msg_delay -- see the SyncedTraceLog class
-            forward_amort -- see the SyncedTraceLog class
-            backward_amort -- see the SyncedTraceLog class
+            data, process_id, pointer_size, minimal_event_diff,
+            minimum_msg_delay, forward_amort, backward_amort, index,
+            batch_clock, stream, index_cache -- see SyncedTraceBase
             communicator -- MPI communicator
+            inplace_export -- if True, the export copies the original data
+                              into the file and overwrites times within
+                              the mapped file
+            transport -- exchanges sent and receive times with other
+                         processes (see Transport), if None, times are
+                         exchanged one by one over the communicator
+            waits -- None or a WaitLog, blocking waits for sent times are
+                     recorded into it
+            checkpoint -- if True, positions of receive events are kept, so
+                          the trace can be checkpointed (see resume)
         """
-        Trace.__init__(self, data, process_id, pointer_size)
+        SyncedTraceBase.__init__(self, data, process_id, pointer_size,
+                                 minimal_event_diff, minimum_msg_delay,
+                                 forward_amort, backward_amort, index=index,
+                                 batch_clock=batch_clock, stream=stream,
+                                 index_cache=index_cache)
         self._messages = None
-        self._minimal_event_diff = minimal_event_diff
-        self._minimum_msg_delay = minimum_msg_delay
-        self._forward_amort = forward_amort
-        self._backward_amort = backward_amort
         self._communicator = communicator
-        self._data_list = []
-        self._header_info = self.data[:self.pointer]
-        self._last_event_time = 0
-        self._send_events = OrderedDict()
-        self._last_received_sent_time = 0
-        self._last_receive_event_time = 0
-        self._violating_recv_events = OrderedDict()
-        self._requests = []
+        if transport is None:
+            # Imported here, engines with own transports do not need MPI
+            from transport import Transport
+            transport = Transport(communicator)
+        self._transport = transport
+        self._waits = waits
+        self._inplace_export = inplace_export
+        # Positions of receive events by sender, replies are sent again
+        # from them after a restart (see resume)
+        self._receipts = defaultdict(list) if checkpoint else None
+        # Receive times of messages received before a restart by recipient,
+        # the messages are not sent again (see resume)
+        self._resumed_receipts = {}
+        # Counts of receipts whose replies senders got before a restart by
+        # sender, the replies are not sent again (see resume)
+        self._replied_receipts = {}
         
-    def _clock_check(self, time, start_pointer, end_pointer=False, \
-                     is_receive=False, sent_time=0):
-        """ Checks, computes and repairs an event timestamp
-            
-            Arguments:
-            time -- a timestamp to be checked
-            start_pointer -- a pointer value before an event unpacking/reading
-            end_pointer -- a pointer value after the event unpacking/reading, 
-                            if False self.pointer is used
-            is_receive -- marks a receive event
-            sent_time -- a timestamp of corresponding send event
-         """
-        newtime = 0
-        
-        if not is_receive:
-            newtime = self._clock(time + self.time_offset)
-        else:
-            newtime = self._clock_receive(time + self.time_offset, sent_time)
-        
-        # Save time to the data list
-        self._repair_time(newtime, start_pointer, end_pointer)
-        
-        return newtime            
-    
-    def _clock(self, time):
-        """ Computes a new time for a process's internal event 
-            
-            Arguments:
-            time -- the time to be fixed
+    def flush_stream(self):
+        """ Writes out events which no later correction can change now,
+            without waiting for the window of events to fill up (see
+            _finalize)
         """
-        newtime = 0
-        if self._last_event_time != 0:
-            newtime = max([time, self._last_event_time + \
-                           self._minimal_event_diff])
-        else:
-            newtime = time
-        
-        self._last_event_time = newtime
-        
-        return newtime
+        self._finalize()
+        self._stream[0].flush()
     
-    def _clock_receive(self, time, sent_time):
-        """ Computes a new time for a process's receive event 
-            
-            Arguments:
-            time -- the time to be fixed
-            sent_time -- time of the corresponding send event
-        """
-        newtime = 0
-        if self._last_event_time != 0:
-            newtime = max([sent_time + self._minimum_msg_delay, time, \
-                           self._last_event_time + \
-                           self._minimal_event_diff])
-        else:
-            newtime = max([sent_time + self._minimum_msg_delay, time])
-        
-        if self._forward_amort:
-            self._forward_amortization(time, newtime)
-        if self._backward_amort:
-            if newtime > time:
-                self._violating_recv_events[newtime] = newtime - time
-                self._last_violating_recv_index = len(self._data_list) - 1
-        
-        self._last_event_time = newtime
-        self._last_receive_event_time = newtime
-        
-        return newtime
-        
-    def _forward_amortization(self, origin_time, new_time):
-        """ Checks shift of a receive event. If a shift exists the time offset 
-            is increased to keep the spacing between two events
-            (Forward amortization)
-            
-            Arguments:
-            origin_time -- original timestamp of an receive event
-            new_time -- corrected/synchronized timestamp of the event
-        """
-        if new_time > origin_time:
-            self.time_offset += new_time - origin_time
+    def complete_replies(self):
+        """ Waits for receive times of all send events of the trace """
+        for time, received_time, target in self._transport.replies(True):
+            self.refill_received_time(time, received_time, target)
     
     def do_backward_amortization(self):
-        """ Applies the backward amortization 
+        """ Applies the backward amortization once receive times of all send
+            events are known
         """
-
-        for r in self._requests:
-            time, request, target = r
-            received_time = request.wait()
-            self.refill_received_time(time, received_time, target)
-
-        if not self._violating_recv_events.keys():
-            return
-        
-        # Reduces collective messages into one
-        for t in self._send_events.keys():
-            send_events = self._send_events[t]
-            if len(send_events) > 1:
-                index = send_events.index(min([e.offset for e in send_events]))
-                self._send_events[t] = send_events[index]
-            else:
-                self._send_events[t] = send_events[0]
-        
-        offset = self._violating_recv_events[self._violating_recv_events.keys()[-1]]
-        for event in self._data_list[ self._last_violating_recv_index - 1 : : -1 ]:
-            if event[0] == "M":
-                max_offset = self._send_events[ event[1] ].offset
-                if max_offset < offset:
-                    offset = max_offset
-            tmp_time = event[1]
-            event[1] += offset
-            if event[0] == "R" and tmp_time in self._violating_recv_events.keys():
-                offset += self._violating_recv_events[ tmp_time ]
+        self.complete_replies()
+        SyncedTraceBase.do_backward_amortization(self)
     
-    def refill_received_time(self, sent_time, received_time, receiver, new_record=True):
-        """ Backward amortization - adds receive time for a specific sent time 
-            and compute maximum offset
-            
-            Arguments:
-            sent_time -- time of a corresponding send event
-            receive_time -- time of a receipt of the msg to be filled
-            new_record -- if True you are adding missing received time otherwise
-                            you are updating an existing received time
+    def export_data(self, path):
+        """ Saves synchronized data in a raw binary form into the file, 
+            a streamed trace is finished in its own file
         """
-        for event in self._send_events[sent_time]:
-            if event.receiver == receiver:
-                event.receive = received_time
-                event.offset = received_time - \
-                    self._minimum_msg_delay - sent_time
-                break
         
+        if self._stream is not None:
+            self.finish_stream()
+            self._stream[0].close()
+            return
+        if self._inplace_export:
+            self._export_inplace(path)
+            return
+        with open(path, "wb") as f:
+            f.write(self.export_raw())
     
-    def export_data(self, path):
+    def export_raw(self):
         """ Returns synchronized data in a raw binary form. """
-        
-        stream = StringIO()
-        stream.write(self._header_info)
-        for event in self._data_list:
-            event[1] = self.struct_basic.pack(event[1])
-            for data in event:
-                stream.write(data)
-        export = stream.getvalue()
-        stream.close()
-        with open(path, "wb") as f:
-            f.write(export)
-        
+        export = bytearray(self.data)
+        self._events.patch(export)
+        return export
     
-    def get_msg_sender(self):
-        """ Returns None or the id of a process, who is the sender of the received
-            message, if the next event is receive event
+    def _export_inplace(self, path):
+        """ Copies the original data into the file and overwrites times of
+            events within the mapped file by the synchronized ones
         """
-        if self.get_next_event_name() == "Recv ":
-            tmp_pointer = self.pointer
-            self.pointer += 1
-            origin_id = self._read_struct_receive()[1]
-            self.pointer = tmp_pointer
-            return origin_id
-        else:
-            return None
-        
-    def get_last_received_sent_time(self):
-        """ Returns last received (got from messages) sent time. """
-        return self._last_received_sent_time
-    
-    def get_last_receive_event_time(self):
-        """ Returns time of last synchronized receive event """
-        return self._last_receive_event_time
+        with open(path, "w+b") as f:
+            f.write(self.data)
+            f.flush()
+            if not len(self._events):
+                return
+            export = mmap.mmap(f.fileno(), 0)
+            self._events.patch(export)
+            export.close()
     
-    def _repair_time(self, time, start_pointer, end_pointer):
-        """ Overwrites original time in tracelog's data string with the new one 
-            
-            Arguments:
-            time -- a new time to be saved
-            start_pointer -- points to the start of event's data
-            end_pointer -- points to the end of event ('s data)
+    def is_blocked(self):
+        """ Returns True if the next event is a receive event whose sent
+            time has not arrived yet
         """
-        event = self._data_list[-1]
-        event.append(time)
-        start_pointer += self.struct_basic.size
-        if end_pointer is False:
-            end_pointer = self.pointer
-        event.append( self.data[ start_pointer : end_pointer ] )
-
-
+        origin_id = self.get_msg_sender()
+        return origin_id is not None and \
+            not self._transport.can_receive(origin_id)
+        
+    def get_event_index(self):
+        """ Returns the count of processed events, the index of the next
+            event within the trace
+        """
+        return self._base + len(self._events)
+    
     def _extra_time(self, time, pointer, receive=False, origin_id=None):
         """ Calls functions for time synchronization
         
@@ -242,76 +146,157 @@ class ParallelSyncedTrace(Trace):
         else:
             if origin_id is None:
                 raise Exception("Origin_id for a receive event not entered!")
-            req = self._communicator.irecv(source=origin_id, tag=MAIN_COMMUNICATION)
-            sent_time = req.wait()
+            if self._waits is not None and \
+                    not self._transport.can_receive(origin_id):
+                start = tm.time()
+                sent_time = self._transport.receive(origin_id)
+                self._waits.record(self.process_id, origin_id,
+                                   self.get_event_index() - 1, start)
+            else:
+                sent_time = self._transport.receive(origin_id)
             ctime = self._clock_check(time, pointer, False, True, sent_time)
+            if self._receipts is not None:
+                self._receipts[origin_id].append(self._base +
+                                                 len(self._events) - 1)
             if self._backward_amort:
-                self._communicator.isend(ctime, dest=origin_id, tag=BA_COMMUNICATION)
+                if self._replied_receipts.get(origin_id):
+                    self._replied_receipts[origin_id] -= 1
+                else:
+                    self._transport.reply(ctime, origin_id)
             self._last_received_sent_time = sent_time
             return ctime
 
-    def _extra_event_send(self, time, target_id):
+    def _extra_event_send(self, time, target_id, position=None):
         """ Adds trace's list of sends
         
             Arguments:
             time -- already synchronized time of the send event
             target_id -- message recipient
+            position -- position of the send event within the data list,
+                        if None, the send event is the last one
         """
-        self._communicator.isend(time, dest=target_id, tag=MAIN_COMMUNICATION)
-        if self._backward_amort:
-            self._requests.append((time, self._communicator.irecv(source=target_id, 
-                                                        tag=BA_COMMUNICATION),
-                                target_id))
-
-        send_event = SendEvent()
-        send_event.receiver = target_id
-        if time not in self._send_events.keys():
-            self._send_events[time] = [send_event]
+        if position is None:
+            position = self._base + len(self._events) - 1
+        resumed = self._resumed_receipts.get(target_id)
+        if resumed:
+            received_time = resumed.popleft()
+            self._send_events.add(position, target_id, received_time,
+                                  received_time - self._minimum_msg_delay - \
+                                  time)
         else:
-            self._send_events[time].append(send_event)
+            self._transport.send(time, target_id)
+            if self._backward_amort:
+                self._transport.expect_reply(time, target_id)
+            self._send_events.add(position, target_id)
 
         if self._backward_amort:
-            del_req = Queue()
-            for r in self._requests:
-                packet = r[1].test()
-                if packet[0]:
-                    time, request, target = r
-                    received_time = packet[1]
-                    self.refill_received_time(time, received_time, target)
-                    del_req.put(r)
-                else:
-                    break
-            while not del_req.empty():
-                r = del_req.get()
-                self._requests.remove(r)
+            for time, received_time, target in self._transport.replies():
+                self.refill_received_time(time, received_time, target)
     
-    def _extra_event(self, event):
-        """ Stores event symbol into trace's data """
-        self._data_list.append([event])
+    def checkpoint_state(self):
+        """ Returns the state of the forward pass to be stored into
+            a checkpoint, streamed traces cannot be checkpointed
+        """
+        return { "pointer" : self.pointer,
+                 "time_offset" : self.time_offset,
+                 "last_event_time" : self._last_event_time,
+                 "last_received_sent_time" : self._last_received_sent_time,
+                 "last_receive_event_time" : self._last_receive_event_time,
+                 "events" : self._events,
+                 "send_events" : self._send_events,
+                 "violating_recv_events" : self._violating_recv_events,
+                 "last_violating_recv_index" :
+                    self._last_violating_recv_index,
+                 "receipts" : dict(self._receipts) }
     
-    def _extra_value(self):
-        """ Retrieves record of the last processed event """
-        return self._data_list[-1]
+    def restore_state(self, state):
+        """ Continues from a state returned by checkpoint_state, call
+            resume before processing further events
+        """
+        self.pointer = state["pointer"]
+        self.time_offset = state["time_offset"]
+        self._last_event_time = state["last_event_time"]
+        self._last_received_sent_time = state["last_received_sent_time"]
+        self._last_receive_event_time = state["last_receive_event_time"]
+        self._events = state["events"]
+        self._send_events = state["send_events"]
+        self._violating_recv_events = state["violating_recv_events"]
+        self._last_violating_recv_index = state["last_violating_recv_index"]
+        self._receipts = defaultdict(list, state["receipts"])
     
-    def _extra_tokens_add(self, pointer, extra, values):
-        if values:
-            extra.append(self.data[pointer:self.pointer])
-            
-        
+    def channel_counts(self):
+        """ Returns (sent, replied, received), counts of messages sent to
+            every recipient, of replies got from every recipient and of
+            messages received from every sender
+        """
+        sent = Counter(self._send_events.receivers)
+        replied = sent - Counter(self._send_events.waiting_counts())
+        received = dict((origin_id, len(positions)) for origin_id, positions
+                        in self._receipts.iteritems())
+        return (dict(sent), dict(replied), received)
+    
+    def resumed_receipts(self, counts):
+        """ Returns sender id -> receive times of messages received before
+            the checkpoint of this trace and sent after the checkpoint of
+            the sender, the sender gets them through resume
 
-class SendEvent(object):
-    """ Send event structure.
+            Arguments:
+            counts -- channel_counts of all traces by trace id
+        """
+        result = {}
+        for origin_id, positions in self._receipts.iteritems():
+            sent = counts[origin_id][0].get(self.process_id, 0)
+            if len(positions) > sent:
+                result[origin_id] = [ self._events.times[position - self._base]
+                                      for position in positions[sent:] ]
+        return result
     
-        Attributes:
-        time -- sent time
-        receive -- received time
-        receiver -- a recipient of the message
-        offset -- difference between received and sent time 
-    """
-    def  __init__(self):
-        self.time = 0
-        self.receive = 0
-        self.receiver = None
-        self.offset = 0
-        
-    
\ No newline at end of file
+    def resume(self, counts, receipts):
+        """ Restores the exchange of times after a restart from checkpoints
+            taken by traces independently. The processing is deterministic,
+            so times are recomputed the same way from the restored states:
+            messages which recipients have not received by their checkpoints
+            are sent again, messages already received are not sent again
+            when they are recreated and their receipts are filled from
+            the given receive times, replies are sent again to senders which
+            have not got them by their checkpoints and not sent again when
+            senders got them.
+            
+            Arguments:
+            counts -- channel_counts of all traces by trace id
+            receipts -- recipient id -> receive times of messages sent after
+                        the checkpoint of this trace (see resumed_receipts)
+        """
+        process_id = self.process_id
+        sent = self.channel_counts()[0]
+        times = self._events.times
+        records = self._send_events
+        if self._backward_amort:
+            for position, target_id in records.waiting_records():
+                self._transport.expect_reply(times[position - self._base],
+                                             target_id)
+        for target_id, received_times in receipts.iteritems():
+            self._resumed_receipts[target_id] = deque(received_times)
+        for target_id in xrange(len(counts)):
+            got = counts[target_id][2].get(process_id, 0)
+            if got < sent.get(target_id, 0):
+                positions = [ position for position, receiver in 
+                              zip(records.events, records.receivers)
+                              if receiver == target_id ]
+                for position in positions[got:]:
+                    self._transport.send(times[position - self._base],
+                                         target_id)
+        if self._backward_amort:
+            for origin_id in xrange(len(counts)):
+                positions = self._receipts.get(origin_id, ())
+                replied = counts[origin_id][1].get(process_id, 0)
+                origin_sent = counts[origin_id][0].get(process_id, 0)
+                for position in positions[replied:origin_sent]:
+                    self._transport.reply(times[position - self._base],
+                                          origin_id)
+                if replied > len(positions):
+                    self._replied_receipts[origin_id] = replied - \
+                                                        len(positions)
+        # Times sent again are not held back in batches, every recipient
+        # may be blocked on them
+        self._transport.flush()
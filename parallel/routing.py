@@ -0,0 +1,197 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+""" Exchange of times among traces when one process synchronizes several
+    traces, independent of the way processes communicate. The MPI engine
+    (see transport.py) and the multiprocessing one (see multicore.py) only
+    add how batches of records travel.
+"""
+
+from collections import deque
+
+# Kinds of exchanged times, MPI tags of messages carrying them
+MAIN_COMMUNICATION = 1
+BA_COMMUNICATION = 2
+
+
+class RouterBase(object):
+    """ Delivers times among traces of processes. A time for a trace of
+        the same process is put straight into a local queue, times for other
+        processes are coalesced per process into batches of records (kind,
+        origin trace, target trace, time). Traces use the router through
+        RoutedTransport.
+
+        Subclasses send and receive batches by _append, poll, _wait_batch
+        and flush, they dispatch records of received batches by _deliver.
+
+        Attributes:
+        local_id -- id of this process
+        owners -- owners[trace id] is the process synchronizing the trace
+        batch_size -- maximum count of records in one batch
+    """
+
+    def __init__(self, local_id, owners, batch_size):
+        self.local_id = local_id
+        self.owners = owners
+        self.batch_size = batch_size
+        # (origin, target) -> sent times
+        self._times = {}
+        # target -> (origin, receive time) replied to the target
+        self._replies = {}
+
+    def endpoint(self, trace_id):
+        """ Returns a transport for the trace """
+        return RoutedTransport(self, trace_id)
+
+    def put(self, kind, origin_id, target_id, time):
+        """ Delivers a time of the kind (MAIN_COMMUNICATION or
+            BA_COMMUNICATION) from the origin trace to the target trace
+        """
+        owner = self.owners[target_id]
+        if owner == self.local_id:
+            self._deliver(kind, origin_id, target_id, time)
+        else:
+            self._append(owner, kind, origin_id, target_id, time)
+
+    def times(self, origin_id, target_id):
+        """ Returns the queue of times sent from the origin to the target """
+        times = self._times.get((origin_id, target_id))
+        if times is None:
+            times = self._times[(origin_id, target_id)] = deque()
+        return times
+
+    def replies(self, target_id):
+        """ Returns the queue of (origin, receive time) replied to the target
+        """
+        replies = self._replies.get(target_id)
+        if replies is None:
+            replies = self._replies[target_id] = deque()
+        return replies
+
+    def poll(self):
+        """ Dispatches all batches which have already arrived, does not block
+        """
+        raise NotImplementedError()
+
+    def wait(self):
+        """ Sends all buffered records and blocks until a batch arrives """
+        self.flush()
+        self._wait_batch()
+        self.poll()
+
+    def flush(self):
+        """ Sends all buffered records """
+        raise NotImplementedError()
+
+    def close(self):
+        """ Sends all buffered records and waits until they are delivered """
+        self.flush()
+
+    def _append(self, owner, kind, origin_id, target_id, time):
+        """ Adds a record to the batch for the owner process, sends the batch
+            once it is full
+        """
+        raise NotImplementedError()
+
+    def _wait_batch(self):
+        """ Blocks until a batch arrives and dispatches it """
+        raise NotImplementedError()
+
+    def _deliver(self, kind, origin_id, target_id, time):
+        if kind == MAIN_COMMUNICATION:
+            self.times(origin_id, target_id).append(time)
+        else:
+            self.replies(target_id).append((origin_id, time))
+
+
+class QueuedReplies(object):
+    """ Pairs send events of one trace waiting for receive times with
+        the times replied into a queue of (recipient, receive time). Replies
+        of one recipient come in the order of its receive events, that is in
+        the order of sending.
+    """
+
+    def __init__(self, replies):
+        # recipient -> sent times of send events waiting for a reply
+        self._waiting = {}
+        self._replies = replies
+
+    def expect_reply(self, sent_time, target_id):
+        """ Registers a send event waiting for the receive time of its
+            message (see replies)
+        """
+        waiting = self._waiting.get(target_id)
+        if waiting is None:
+            waiting = self._waiting[target_id] = deque()
+        waiting.append(sent_time)
+
+    def replies(self, wait=False):
+        """ Returns a list of (sent time, receive time, recipient) of replied
+            send events and forgets them
+
+            Arguments:
+            wait -- if True, waits for replies to all send events
+        """
+        if wait:
+            self._wait_replies()
+        result = []
+        replies = self._replies
+        while replies:
+            origin_id, received_time = replies.popleft()
+            result.append((self._waiting[origin_id].popleft(), received_time,
+                           origin_id))
+        return result
+
+    def _wait_replies(self):
+        """ Blocks until replies to all send events are in the queue, they are
+            there already unless a subclass delivers them meanwhile
+        """
+        pass
+
+    def _pending_count(self):
+        """ Returns the count of send events waiting for a reply """
+        return sum(len(w) for w in self._waiting.itervalues())
+
+
+class RoutedTransport(QueuedReplies):
+    """ Transport of one trace synchronized by a process together with other
+        traces (see RouterBase), it has the interface of Transport. Ids of
+        processes are ids of traces here. A receive blocks only if the time
+        has not arrived, the process then dispatches incoming batches until
+        it does.
+    """
+
+    def __init__(self, router, trace_id):
+        QueuedReplies.__init__(self, router.replies(trace_id))
+        self.router = router
+        self.trace_id = trace_id
+
+    def send(self, time, target_id):
+        self.router.put(MAIN_COMMUNICATION, self.trace_id, target_id, time)
+
+    def receive(self, origin_id):
+        times = self.router.times(origin_id, self.trace_id)
+        while not times:
+            self.router.wait()
+        return times.popleft()
+
+    def can_receive(self, origin_id):
+        """ Returns True if a sent time from the origin has already been
+            dispatched by the router, does not check arrived batches
+        """
+        return len(self.router.times(origin_id, self.trace_id)) > 0
+
+    def reply(self, time, origin_id):
+        self.router.put(BA_COMMUNICATION, self.trace_id, origin_id, time)
+
+    def flush(self):
+        self.router.flush()
+
+    def close(self):
+        self.router.close()
+
+    def _wait_replies(self):
+        pending = self._pending_count()
+        while len(self._replies) < pending:
+            self.router.wait()
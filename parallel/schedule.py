@@ -0,0 +1,64 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import heapq
+import time
+
+
+def assign_traces(weights, count):
+    """ Distributes traces among processes so that sums of weights of their
+        traces are balanced (the heaviest trace goes to the least loaded
+        process first). Returns a list, i-th item is the process of i-th trace.
+
+        Arguments:
+        weights -- weights of traces, e.g. sizes or counts of events
+        count -- count of processes
+    """
+    owners = [None] * len(weights)
+    loads = [ (0, process) for process in xrange(count) ]
+    order = sorted(xrange(len(weights)), key=lambda i: (-weights[i], i))
+    for i in order:
+        load, process = heapq.heappop(loads)
+        owners[i] = process
+        heapq.heappush(loads, (load + weights[i], process))
+    return owners
+
+def run_traces(traces, poll, wait, waits=None, tick=None):
+    """ Processes events of several traces cooperatively. A trace is processed
+        until it ends or until it reaches a receive event whose sent time has
+        not arrived, then the next trace continues. Arrived times are
+        dispatched by poll before each round, when no trace moves in a round,
+        all of them are blocked and wait is called.
+
+        Arguments:
+        traces -- ParallelSyncedTraces
+        poll -- function dispatching arrived times, does not block
+        wait -- function blocking until some sent time arrives
+        waits -- None or a WaitLog, a trace waits from the round it blocks
+                 in until the round it continues in
+        tick -- None or a function called after every round, e.g. to take
+                checkpoints
+    """
+    active = list(traces)
+    # trace -> (start, sender, event) of its current wait
+    blocked = {}
+    while active:
+        poll()
+        progress = False
+        for trace in active:
+            if trace in blocked and not trace.is_blocked():
+                start, sender_id, event = blocked.pop(trace)
+                waits.record(trace.process_id, sender_id, event, start)
+            while not trace.is_pointer_at_end() and not trace.is_blocked():
+                trace.process_next()
+                progress = True
+            if waits is not None and trace not in blocked and \
+                    not trace.is_pointer_at_end():
+                blocked[trace] = (time.time(), trace.get_msg_sender(),
+                                  trace.get_event_index())
+        active = [ trace for trace in active if not trace.is_pointer_at_end() ]
+        if tick is not None:
+            tick()
+        if active and not progress:
+            wait()
@@ -0,0 +1,568 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import numpy as np
+from mpi4py import MPI
+from collections import deque
+from routing import MAIN_COMMUNICATION, BA_COMMUNICATION, RouterBase, \
+                    QueuedReplies
+
+# Count of the oldest requests among which PendingRequests looks for
+# completed ones
+POLL_WINDOW = 64
+
+
+class Transport(object):
+    """ Exchanges sent times of messages among processes one by one, every
+        sent time travels as one pickled message. Requests of sent messages
+        are kept until they complete, the pickled data must not be freed
+        while in flight. Receive times for the backward amortization travel
+        as single int64 values, each send event waiting for one has a posted
+        request, completed requests are found by PendingRequests.
+
+        Attributes:
+        communicator -- MPI communicator
+    """
+
+    def __init__(self, communicator):
+        self.communicator = communicator
+        # Requests of receive times with (sent time, recipient, buffer) of
+        # send events waiting for them, buffers of completed ones are reused
+        self._reply_requests = PendingRequests()
+        self._free_buffers = []
+        self._reply_pool = SendPool(1)
+        # Requests of sent messages which may not be delivered yet
+        self._send_requests = PendingRequests()
+
+    def send(self, time, target_id):
+        """ Sends a time of a send event to the message recipient """
+        self._send_requests.add(
+            self.communicator.isend(time, dest=target_id,
+                                    tag=MAIN_COMMUNICATION))
+
+    def receive(self, origin_id):
+        """ Returns the next sent time from the origin, blocks until it
+            arrives
+        """
+        self.flush()
+        req = self.communicator.irecv(source=origin_id, tag=MAIN_COMMUNICATION)
+        return req.wait()
+
+    def can_receive(self, origin_id):
+        """ Returns True if a sent time from the origin is available, so
+            receive would not block
+        """
+        return self.communicator.Iprobe(source=origin_id,
+                                        tag=MAIN_COMMUNICATION)
+
+    def reply(self, time, origin_id):
+        """ Sends a time of a receive event back to the message sender """
+        buff = self._reply_pool.acquire()
+        buff[0] = time
+        self._reply_pool.send(self.communicator, buff, 1, origin_id,
+                              BA_COMMUNICATION)
+
+    def expect_reply(self, sent_time, target_id):
+        """ Registers a send event waiting for the receive time of its
+            message (see replies)
+        """
+        if self._free_buffers:
+            buff = self._free_buffers.pop()
+        else:
+            buff = np.empty(1, dtype=np.int64)
+        request = self.communicator.Irecv([buff, MPI.INT64_T],
+                                          source=target_id,
+                                          tag=BA_COMMUNICATION)
+        self._reply_requests.add(request, (sent_time, target_id, buff))
+
+    def replies(self, wait=False):
+        """ Returns a list of (sent time, receive time, recipient) of replied
+            send events in order of sending and forgets them. Without waiting
+            some replies may be returned only by later calls (see
+            PendingRequests).
+
+            Arguments:
+            wait -- if True, waits for replies to all send events
+        """
+        if wait:
+            done = self._reply_requests.wait()
+        else:
+            done = self._reply_requests.completed()
+        result = []
+        for sent_time, target_id, buff in done:
+            result.append((sent_time, int(buff[0]), target_id))
+            self._free_buffers.append(buff)
+        return result
+
+    def flush(self):
+        """ Sends all buffered times and forgets requests of delivered ones
+        """
+        self._send_requests.completed()
+        self._reply_pool.reclaim()
+
+    def close(self):
+        """ Sends all buffered times and waits until they are delivered """
+        self._send_requests.wait()
+        self._reply_pool.wait()
+
+
+class BatchedTransport(Transport):
+    """ Coalesces sent times per recipient and sends them in batches. A batch
+        is sent when it is full or when the process is about to block on
+        a receive, so no process waits for times buffered by a blocked one.
+
+        Attributes:
+        communicator -- MPI communicator
+        batch_size -- maximum count of times in one batch
+    """
+
+    def __init__(self, communicator, batch_size):
+        Transport.__init__(self, communicator)
+        self.batch_size = batch_size
+        self._buffers = {}
+        self._received = {}
+
+    def send(self, time, target_id):
+        buff = self._buffers.get(target_id)
+        if buff is None:
+            buff = self._buffers[target_id] = []
+        buff.append(time)
+        if len(buff) >= self.batch_size:
+            self._send_batch(target_id)
+
+    def receive(self, origin_id):
+        received = self._received.get(origin_id)
+        if received is None:
+            received = self._received[origin_id] = deque()
+        if not received:
+            self.flush()
+            received.extend(self.communicator.recv(source=origin_id,
+                                                   tag=MAIN_COMMUNICATION))
+        return received.popleft()
+
+    def can_receive(self, origin_id):
+        if self._received.get(origin_id):
+            return True
+        return Transport.can_receive(self, origin_id)
+
+    def flush(self):
+        for target_id, buff in self._buffers.iteritems():
+            if buff:
+                self._send_batch(target_id)
+        Transport.flush(self)
+
+    def close(self):
+        self.flush()
+        Transport.close(self)
+
+    def _send_batch(self, target_id):
+        batch = self._buffers[target_id]
+        self._buffers[target_id] = []
+        self._send_requests.add(
+            self.communicator.isend(batch, dest=target_id,
+                                    tag=MAIN_COMMUNICATION))
+
+
+class PendingRequests(object):
+    """ Requests in order of posting, each with an item. Completed requests
+        are looked for by Testsome only among the POLL_WINDOW oldest ones,
+        so a look costs O(POLL_WINDOW) however many requests are pending.
+        Requests mostly complete in order of posting, a request beyond
+        the window is seen completed once older ones leave the window.
+    """
+
+    def __init__(self):
+        # Requests and items within the window, the rest waits for a place
+        self._requests = []
+        self._items = []
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._requests) + len(self._queue)
+
+    def add(self, request, item=None):
+        """ Keeps a posted request with its item """
+        if len(self._requests) < POLL_WINDOW:
+            self._requests.append(request)
+            self._items.append(item)
+        else:
+            self._queue.append((request, item))
+
+    def completed(self):
+        """ Returns items of completed requests of the window in order of
+            posting and forgets them
+        """
+        if not self._requests:
+            return []
+        done = MPI.Request.Testsome(self._requests)
+        if not done:
+            return []
+        done = set(done)
+        result = []
+        requests = []
+        items = []
+        for i, item in enumerate(self._items):
+            if i in done:
+                result.append(item)
+            else:
+                requests.append(self._requests[i])
+                items.append(item)
+        queue = self._queue
+        while queue and len(requests) < POLL_WINDOW:
+            request, item = queue.popleft()
+            requests.append(request)
+            items.append(item)
+        self._requests = requests
+        self._items = items
+        return result
+
+    def wait(self):
+        """ Waits for all requests, returns their items in order of posting
+            and forgets them
+        """
+        requests = self._requests + [ r for r, item in self._queue ]
+        items = self._items + [ item for r, item in self._queue ]
+        MPI.Request.Waitall(requests)
+        self._requests = []
+        self._items = []
+        self._queue = deque()
+        return items
+
+
+class SendPool(object):
+    """ Arrays of int64 for batches sent by Isend. An array returns to the pool
+        once its request completes, a new one is allocated only when none of
+        the arrays is known to be delivered, so the pool never waits for
+        a delivery.
+
+        Attributes:
+        size -- count of items in one array
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._free = []
+        self._pending = PendingRequests()
+
+    def acquire(self):
+        """ Returns an array for a new batch """
+        if not self._free:
+            self.reclaim()
+            if not self._free:
+                return np.empty(self.size, dtype=np.int64)
+        return self._free.pop()
+
+    def send(self, communicator, buff, count, process_id, tag):
+        """ Sends first count items of an acquired array """
+        self._pending.add(communicator.Isend([buff, count, MPI.INT64_T],
+                                             dest=process_id, tag=tag),
+                          buff)
+
+    def reclaim(self):
+        """ Returns arrays of delivered batches to the pool """
+        self._free.extend(self._pending.completed())
+
+    def busy(self):
+        """ Returns True if some batch may not be delivered yet """
+        return len(self._pending) > 0
+
+    def wait(self):
+        """ Waits until all batches are delivered """
+        self._free.extend(self._pending.wait())
+
+
+class TypedTransport(Transport):
+    """ Exchanges times as batches of int64 through the buffer interface of
+        MPI, nothing is pickled. Sent times and receive times replied for
+        the backward amortization are coalesced per process into arrays
+        taken from a SendPool.
+
+        Receive times come back in the same order as the times were sent to
+        a process, so they are matched with send events waiting in a queue
+        per recipient and no request is posted for a single send event.
+
+        Attributes:
+        communicator -- MPI communicator
+        batch_size -- maximum count of times in one batch, 1 sends every time
+                      immediately
+    """
+
+    def __init__(self, communicator, batch_size=1):
+        Transport.__init__(self, communicator)
+        self.batch_size = batch_size
+        # (tag, process) -> [array or None, count of times in the array]
+        self._outgoing = {}
+        self._pool = SendPool(batch_size)
+        self._received = {}
+        self._waiting = {}
+        self._recv_buffer = np.empty(batch_size, dtype=np.int64)
+        self._status = MPI.Status()
+
+    def send(self, time, target_id):
+        self._put(MAIN_COMMUNICATION, target_id, time)
+
+    def receive(self, origin_id):
+        received = self._received.get(origin_id)
+        if received is None:
+            received = self._received[origin_id] = deque()
+        if not received:
+            self.flush()
+            received.extend(self._recv_batch(origin_id, MAIN_COMMUNICATION))
+        return received.popleft()
+
+    def can_receive(self, origin_id):
+        if self._received.get(origin_id):
+            return True
+        return Transport.can_receive(self, origin_id)
+
+    def reply(self, time, origin_id):
+        self._put(BA_COMMUNICATION, origin_id, time)
+
+    def expect_reply(self, sent_time, target_id):
+        waiting = self._waiting.get(target_id)
+        if waiting is None:
+            waiting = self._waiting[target_id] = deque()
+        waiting.append(sent_time)
+
+    def replies(self, wait=False):
+        result = []
+        status = self._status
+        while self.communicator.Iprobe(source=MPI.ANY_SOURCE,
+                                       tag=BA_COMMUNICATION, status=status):
+            self._match_replies(status.Get_source(), result)
+        if wait:
+            # Receive times replied by this process may be buffered, other
+            # processes may be blocked on them the same way
+            self.flush()
+            for target_id, waiting in self._waiting.iteritems():
+                while waiting:
+                    self._match_replies(target_id, result)
+        return result
+
+    def flush(self):
+        for key, out in self._outgoing.iteritems():
+            if out[1]:
+                self._send_batch(key, out)
+        self._pool.reclaim()
+
+    def close(self):
+        self.flush()
+        self._pool.wait()
+
+    def _put(self, tag, process_id, time):
+        key = (tag, process_id)
+        out = self._outgoing.get(key)
+        if out is None:
+            out = self._outgoing[key] = [None, 0]
+        if out[0] is None:
+            out[0] = self._pool.acquire()
+        out[0][out[1]] = time
+        out[1] += 1
+        if out[1] == self.batch_size:
+            self._send_batch(key, out)
+
+    def _send_batch(self, key, out):
+        tag, process_id = key
+        self._pool.send(self.communicator, out[0], out[1], process_id, tag)
+        out[0] = None
+        out[1] = 0
+
+    def _recv_batch(self, process_id, tag):
+        """ Receives one batch and returns its times as a list """
+        self.communicator.Recv([self._recv_buffer, MPI.INT64_T],
+                               source=process_id, tag=tag, status=self._status)
+        count = self._status.Get_count(MPI.INT64_T)
+        return self._recv_buffer[:count].tolist()
+
+    def _match_replies(self, process_id, result):
+        waiting = self._waiting[process_id]
+        for received_time in self._recv_batch(process_id, BA_COMMUNICATION):
+            result.append((waiting.popleft(), received_time, process_id))
+
+
+class Router(RouterBase):
+    """ Delivers times among traces when one process synchronizes several
+        traces (see RouterBase), batches of records are sent as int64 arrays.
+
+        Attributes:
+        communicator -- MPI communicator
+        owners -- owners[trace id] is the rank synchronizing the trace
+        batch_size -- maximum count of records in one batch
+    """
+
+    RECORD_SIZE = 4
+
+    def __init__(self, communicator, owners, batch_size):
+        RouterBase.__init__(self, communicator.Get_rank(), owners, batch_size)
+        self.communicator = communicator
+        # rank -> [array or None, count of records in the array]
+        self._outgoing = {}
+        self._pool = SendPool(batch_size * self.RECORD_SIZE)
+        self._recv_buffer = np.empty(batch_size * self.RECORD_SIZE,
+                                     dtype=np.int64)
+        self._status = MPI.Status()
+
+    def poll(self):
+        """ Dispatches all batches which have already arrived, does not block
+        """
+        status = self._status
+        while self.communicator.Iprobe(source=MPI.ANY_SOURCE,
+                                       tag=MAIN_COMMUNICATION, status=status):
+            self._recv_batch(status.Get_source())
+
+    def flush(self):
+        for owner, out in self._outgoing.iteritems():
+            if out[1]:
+                self._send_batch(owner, out)
+        self._pool.reclaim()
+
+    def close(self):
+        """ Sends all buffered records and waits until they are delivered,
+            arrived batches are dispatched meanwhile, their senders may be
+            waiting for the delivery the same way
+        """
+        self.flush()
+        while self._pool.busy():
+            self.poll()
+            self._pool.reclaim()
+
+    def _append(self, owner, kind, origin_id, target_id, time):
+        out = self._outgoing.get(owner)
+        if out is None:
+            out = self._outgoing[owner] = [None, 0]
+        if out[0] is None:
+            out[0] = self._pool.acquire()
+        position = out[1] * self.RECORD_SIZE
+        out[0][position : position + self.RECORD_SIZE] = \
+            (kind, origin_id, target_id, time)
+        out[1] += 1
+        if out[1] == self.batch_size:
+            self._send_batch(owner, out)
+
+    def _wait_batch(self):
+        self.communicator.Probe(source=MPI.ANY_SOURCE, tag=MAIN_COMMUNICATION,
+                                status=self._status)
+        self._recv_batch(self._status.Get_source())
+
+    def _send_batch(self, owner, out):
+        self._pool.send(self.communicator, out[0], out[1] * self.RECORD_SIZE,
+                        owner, MAIN_COMMUNICATION)
+        out[0] = None
+        out[1] = 0
+
+    def _recv_batch(self, process_id):
+        self.communicator.Recv([self._recv_buffer, MPI.INT64_T],
+                               source=process_id, tag=MAIN_COMMUNICATION,
+                               status=self._status)
+        count = self._status.Get_count(MPI.INT64_T)
+        records = self._recv_buffer[:count].tolist()
+        deliver = self._deliver
+        for i in xrange(0, count, self.RECORD_SIZE):
+            deliver(*records[i : i + self.RECORD_SIZE])
+
+
+class DeferredReplies(object):
+    """ Keeps receive times replied for the backward amortization until the
+        forward pass of all processes ends, then delivers them to the traces
+        of their senders by one Alltoallv, so no reply travels during the
+        forward pass. Every receive time is a record (receiving trace, sending
+        trace, receive time). Traces use it through DeferredTransport.
+
+        Attributes:
+        communicator -- MPI communicator
+        owners -- owners[trace id] is the rank synchronizing the trace
+    """
+
+    RECORD_SIZE = 3
+
+    def __init__(self, communicator, owners):
+        self.communicator = communicator
+        self.owners = owners
+        # rank -> flat list of records
+        self._outgoing = {}
+        # target -> (origin, receive time) replied to the target
+        self._replies = {}
+
+    def endpoint(self, transport, trace_id):
+        """ Returns a transport for the trace replying through this object,
+            other times are exchanged by the given transport
+        """
+        return DeferredTransport(transport, self, trace_id)
+
+    def put(self, origin_id, target_id, time):
+        """ Stores a receive time replied by the origin trace to the target
+            trace
+        """
+        owner = self.owners[target_id]
+        records = self._outgoing.get(owner)
+        if records is None:
+            records = self._outgoing[owner] = []
+        records.extend((origin_id, target_id, time))
+
+    def replies(self, target_id):
+        """ Returns the queue of (origin, receive time) replied to the target
+        """
+        replies = self._replies.get(target_id)
+        if replies is None:
+            replies = self._replies[target_id] = deque()
+        return replies
+
+    def exchange(self):
+        """ Delivers all stored receive times, a collective operation """
+        size = self.communicator.Get_size()
+        send_counts = np.array([ len(self._outgoing.get(r, ()))
+                                 for r in xrange(size) ], dtype=np.int32)
+        recv_counts = np.empty(size, dtype=np.int32)
+        self.communicator.Alltoall([send_counts, MPI.INT],
+                                   [recv_counts, MPI.INT])
+        send_buffer = np.array([ value for r in xrange(size)
+                                 for value in self._outgoing.get(r, ()) ],
+                               dtype=np.int64)
+        recv_buffer = np.empty(recv_counts.sum(), dtype=np.int64)
+        self.communicator.Alltoallv(
+            [send_buffer, (send_counts, _displacements(send_counts)),
+             MPI.INT64_T],
+            [recv_buffer, (recv_counts, _displacements(recv_counts)),
+             MPI.INT64_T])
+        self._outgoing = {}
+        records = recv_buffer.tolist()
+        for i in xrange(0, len(records), self.RECORD_SIZE):
+            origin_id, target_id, time = records[i : i + self.RECORD_SIZE]
+            self.replies(target_id).append((origin_id, time))
+
+
+class DeferredTransport(QueuedReplies):
+    """ Transport of one trace replying receive times through DeferredReplies,
+        sent times are exchanged by the wrapped transport. Replies are
+        available only after DeferredReplies.exchange.
+    """
+
+    def __init__(self, transport, deferred, trace_id):
+        QueuedReplies.__init__(self, deferred.replies(trace_id))
+        self.transport = transport
+        self.deferred = deferred
+        self.trace_id = trace_id
+
+    def send(self, time, target_id):
+        self.transport.send(time, target_id)
+
+    def receive(self, origin_id):
+        return self.transport.receive(origin_id)
+
+    def can_receive(self, origin_id):
+        return self.transport.can_receive(origin_id)
+
+    def reply(self, time, origin_id):
+        self.deferred.put(self.trace_id, origin_id, time)
+
+    def flush(self):
+        self.transport.flush()
+
+    def close(self):
+        self.transport.close()
+
+
+def _displacements(counts):
+    """ Returns starts of blocks of the given counts in one buffer """
+    return np.cumsum(counts) - counts
@@ -0,0 +1,108 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import json
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+
+
+class WaitLog(object):
+    """ Blocking waits of traces for sent times. Wall clock times of waits
+        from different processes are compared by the analysis, so clocks of
+        nodes are expected to agree (e.g. by NTP).
+
+        Attributes:
+        records -- list of (trace, sender, event, start, end), a trace waited
+                   from start to end [s] at its event (index of the receive
+                   event within the trace) for a time sent by the sender
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, trace_id, sender_id, event, start, end=None):
+        """ Stores a wait, it ends now if end is None """
+        if end is None:
+            end = time.time()
+        self.records.append((trace_id, sender_id, event, start, end))
+
+
+def wait_chains(records):
+    """ Links every wait to the wait of its sender which ended last before
+        the wait itself ended, the sender could not send the time earlier
+        than it was released. Returns a list of (total, previous) per wait,
+        total is the sum of durations of the chain ending by the wait and
+        previous is the index of the preceding wait or None.
+
+        Arguments:
+        records -- waits of all traces (see WaitLog)
+    """
+    ends = defaultdict(list)
+    waits = defaultdict(list)
+    order = sorted(xrange(len(records)), key=lambda i: records[i][4])
+    chains = [None] * len(records)
+    for i in order:
+        trace_id, sender_id, event, start, end = records[i]
+        previous = None
+        total = end - start
+        sender_ends = ends[sender_id]
+        j = bisect_left(sender_ends, end) - 1
+        if j >= 0:
+            previous = waits[sender_id][j]
+            total += chains[previous][0]
+        chains[i] = (total, previous)
+        ends[trace_id].append(end)
+        waits[trace_id].append(i)
+    return chains
+
+def analyze(records, owners, count=10):
+    """ Returns the longest wait chains (not continued by any other wait)
+        and total waits of processes and traces, the most stalled first
+
+        Arguments:
+        records -- waits of all traces (see WaitLog)
+        owners -- i-th item is the process synchronizing the i-th trace
+        count -- count of reported chains
+    """
+    chains = wait_chains(records)
+    continued = set(previous for total, previous in chains)
+    heads = sorted((i for i in xrange(len(records)) if i not in continued),
+                   key=lambda i: -chains[i][0])
+    reported = []
+    for head in heads[:count]:
+        links = []
+        i = head
+        while i is not None:
+            trace_id, sender_id, event, start, end = records[i]
+            links.append(OrderedDict((("trace", trace_id),
+                                      ("sender", sender_id),
+                                      ("event", event),
+                                      ("wait", end - start))))
+            i = chains[i][1]
+        links.reverse()
+        reported.append(OrderedDict((("total", chains[head][0]),
+                                     ("links", links))))
+
+    process_waits = defaultdict(float)
+    trace_waits = defaultdict(float)
+    for trace_id, sender_id, event, start, end in records:
+        process_waits[owners[trace_id]] += end - start
+        trace_waits[trace_id] += end - start
+    result = OrderedDict()
+    result["waits"] = len(records)
+    result["chains"] = reported
+    result["processes"] = [ OrderedDict((("process", p), ("wait", w)))
+                            for p, w in sorted(process_waits.iteritems(),
+                                               key=lambda x: -x[1]) ]
+    result["traces"] = [ OrderedDict((("trace", t), ("wait", w)))
+                         for t, w in sorted(trace_waits.iteritems(),
+                                            key=lambda x: -x[1]) ]
+    return result
+
+def write_report(filename, records, owners, count=10):
+    """ Stores the analysis of waits (see analyze) as JSON """
+    with open(filename, "w") as f:
+        json.dump(analyze(records, owners, count), f, indent=2)
+        f.write("\n")
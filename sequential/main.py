@@ -1,27 +1,107 @@
 from syncedtracelog import SyncedTraceLog
-import sys
+from sweep import SweepTraceLog
+from stats import Stats, write_summary
+import argparse
 import os.path
 import time
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+                description="Synchronizes timestamps of a Kaira tracelog")
+    parser.add_argument("tracelog", help="file path to a *.kth")
+    parser.add_argument("min_event_diff", type=int,
+                        help="minimal event difference [ns]")
+    parser.add_argument("min_msg_delay", type=int,
+                        help="minimum message delay between 2 processes [ns]")
+    parser.add_argument("--index", action="store_true",
+                        help="index every trace in one pass before "
+                             "the synchronization")
+    parser.add_argument("--index-cache", action="store_true",
+                        help="keep the index of every trace in a file next "
+                             "to it and reuse it by later runs, implies "
+                             "--index")
+    parser.add_argument("--mmap", action="store_true",
+                        help="map trace files into memory instead of "
+                             "reading them")
+    parser.add_argument("--inplace-export", action="store_true",
+                        help="write traces straight into the output file "
+                             "instead of joining them in memory")
+    parser.add_argument("--batch-clock", action="store_true",
+                        help="compute times of runs of events between "
+                             "receive events at once")
+    parser.add_argument("--stream", action="store_true",
+                        help="write events out during the synchronization "
+                             "once they are final, events not final yet "
+                             "stay in memory")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="store times of phases and counters as JSON")
+    parser.add_argument("--sweep", metavar="DIFF,DELAY", nargs="+",
+                        type=setting,
+                        help="synchronize also with these settings in the same "
+                             "pass and print statistics of all of them, only "
+                             "the tracelog synchronized with min_event_diff "
+                             "and min_msg_delay is saved")
+    args = parser.parse_args()
+    if args.sweep and (args.stream or args.inplace_export or args.stats):
+        parser.error("--sweep cannot be combined with --stream, "
+                     "--inplace-export or --stats")
+    return args
+
+def setting(value):
+    """ Parses a DIFF,DELAY pair of --sweep """
+    try:
+        diff, delay = value.split(",")
+        return (int(diff), int(delay))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected DIFF,DELAY, got " + value)
+
+def sweep(args, path):
+    settings = [ (args.min_event_diff, args.min_msg_delay) ] + args.sweep
+    st = SweepTraceLog(args.tracelog, settings, args.mmap, args.index_cache)
+    print "{0:>15} {1:>15} {2:>12} {3:>15} {4:>12}".format(
+            "min_event_diff", "min_msg_delay", "violations", "total_shift",
+            "max_shift")
+    for s in st.statistics():
+        print "{0:>15} {1:>15} {2:>12} {3:>15} {4:>12}".format(
+                s["min_event_diff"], s["min_msg_delay"], s["violations"],
+                s["total_shift"], s["max_shift"])
+    st.export_to_file(path + "synchronized_trace.kst")
+
 def main():
-    if len(sys.argv) != 4:
-        print "Missing argument!\nArguments:\n1 - file path to a *.kth\n2 - minimal event difference [ns]\n3 - minimum message delay between 2 processes [ns]"
-        return
+    args = parse_args()
     
     exec_start = time.time()
+    stats = Stats()
+    
+    path = os.path.split(args.tracelog)[0]
+    if path != '':
+        path += "/"
+    if args.sweep:
+        sweep(args, path)
+        return
     
-    st = SyncedTraceLog(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), True, True)
+    stream = None
+    if args.stream:
+        stream = path + "synchronized_trace.kst"
+    
+    st = SyncedTraceLog(args.tracelog, args.min_event_diff, args.min_msg_delay,
+                        True, True, index=args.index or args.index_cache,
+                        mmap=args.mmap, inplace_export=args.inplace_export,
+                        batch_clock=args.batch_clock, stream=stream,
+                        stats=stats, index_cache=args.index_cache)
     
     execution_time = time.time() - exec_start
     print "Execution time: {0}".format(execution_time)
-    
-    path = os.path.split(sys.argv[1])[0]
-    if path != '':
-        path += "/"
                 
     st.export_to_file(path + "synchronized_trace.kst")
+    stats.lap("export")
+    
+    if args.stats:
+        for trace in st.traces:
+            stats.count_trace(trace)
+        write_summary(args.stats, [ stats.record() ])
     
     
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
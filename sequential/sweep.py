@@ -0,0 +1,287 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import numpy as np
+from collections import deque, defaultdict
+from tracelog import TraceLog
+from batchclock import clock_run, backward_offsets
+from eventstore import EventStore
+
+INT64_MAX = np.iinfo(np.int64).max
+
+
+class SweepTraceLog(TraceLog):
+    """ Synchronizes a tracelog with several settings of the minimal event
+        difference and of the minimum message delay in one pass. Traces are
+        indexed once (see TraceIndex), times of events are kept in a column
+        per setting and every message carries its sent times of all
+        settings. Forward and backward amortization are on, results of every
+        setting are the same as of SyncedTraceLog with the setting.
+    """
+
+    def __init__(self, filename, settings, use_mmap=False, index_cache=False):
+        """ Arguments:
+            filename -- a path to a tracelog file (*.kth)
+            settings -- list of (min_event_diff, min_msg_delay)
+            use_mmap -- True/False, maps trace files into memory
+            index_cache -- True/False, indexes are cached in files next to
+                           traces (see Trace.build_index)
+        """
+        TraceLog.__init__(self, filename, use_mmap)
+        self.settings = settings
+        diffs = np.array([ s[0] for s in settings ], dtype=np.int64)
+        delays = np.array([ s[1] for s in settings ], dtype=np.int64)
+        starttime = min(trace.get_init_time() for trace in self.traces)
+        self.sweeps = []
+        for trace in self.traces:
+            if index_cache:
+                trace.index_cache = self.trace_filename(trace.process_id)
+            self.sweeps.append(SweepTrace(trace, diffs, delays,
+                                          trace.get_init_time() - starttime))
+        self._synchronize()
+
+    def _synchronize(self):
+        """ Runs every trace until its next receive has no sent message,
+            the same way as SyncedTraceLog does
+        """
+        # (sender, recipient) -> messages, (sending trace, record, sent times)
+        channels = defaultdict(deque)
+        ready = deque(xrange(self.process_count))
+        parked = defaultdict(list)
+        while ready:
+            current_p = ready.popleft()
+            sender = self.sweeps[current_p].run(channels)
+            if sender is not None:
+                parked[sender].append(current_p)
+            waiting = parked.pop(current_p, None)
+            if waiting:
+                for receiver in waiting:
+                    if channels[(current_p, receiver)]:
+                        ready.append(receiver)
+                    else:
+                        parked[current_p].append(receiver)
+        if parked:
+            raise Exception("Receives without sent messages (a deadlock or "
+                            "unmatched receives): " +
+                            ", ".join("process {0} waits for {1}"
+                                      .format(receiver, sender)
+                                      for sender, receivers in
+                                      sorted(parked.iteritems())
+                                      for receiver in receivers))
+        for sweep in self.sweeps:
+            sweep.do_backward_amortization()
+
+    def statistics(self):
+        """ Returns a list of dictionaries, one per setting, with the setting,
+            count of corrected receive events (violations), the sum and
+            the maximum of shifts of events against their original times
+        """
+        result = []
+        for i, (diff, delay) in enumerate(self.settings):
+            shifts = [ sweep.shifts(i) for sweep in self.sweeps ]
+            result.append({ "min_event_diff" : diff,
+                            "min_msg_delay" : delay,
+                            "violations" : sum(sweep.violation_count(i)
+                                               for sweep in self.sweeps),
+                            "total_shift" : sum(int(s.sum()) for s in shifts),
+                            "max_shift" : max([ int(s.max()) for s in shifts
+                                                if len(s) ] or [ 0 ]) })
+        return result
+
+    def export_to_file(self, filename, setting=0):
+        """ Saves the tracelog synchronized with one setting into a file
+
+            Arguments:
+            filename -- Path to a *.kst
+            setting -- position of the setting within settings
+        """
+        data = str(self.pointer_size) + '\n' + str(self.process_count) + '\n'
+        traces = [ sweep.export_data(setting) for sweep in self.sweeps ]
+        data += "".join(str(len(t)) + '\n' for t in traces)
+        with open(self.filename, "r") as f:
+            f.readline()
+            rest = f.read()
+        with open(filename, "wb") as f:
+            f.write(data)
+            for t in traces:
+                f.write(t)
+            f.write(rest)
+
+
+class SweepTrace(object):
+    """ Times of events of one trace for several settings, a row per event
+        and a column per setting
+    """
+
+    def __init__(self, trace, diffs, delays, time_offset):
+        """ Arguments:
+            trace -- the Trace
+            diffs -- int64 array of minimal event differences of settings
+            delays -- int64 array of minimum message delays of settings
+            time_offset -- difference of the init time of the trace and
+                           the reference init time
+        """
+        self.trace = trace
+        self.index = trace.index
+        if self.index is None:
+            self.index = trace.build_index()
+        self.diffs = diffs
+        self.delays = delays
+        count = len(self.index)
+        settings = len(diffs)
+        self.times = np.zeros((count, settings), dtype=np.int64)
+        # Forward amortization shifts time offsets of settings differently
+        self.time_offsets = np.empty(settings, dtype=np.int64)
+        self.time_offsets.fill(time_offset)
+        self._original_offset = time_offset
+        self._last_event_times = np.zeros(settings, dtype=np.int64)
+        self._position = 0
+        self._receives = self.index.positions("R")
+        # Violations of receive events (a row per receive event) and
+        # the last violating receive event of every setting
+        self._violations = np.zeros((len(self._receives), settings),
+                                    dtype=np.int64)
+        self._last_violating = np.zeros(settings, dtype=np.int64)
+        self._last_violating.fill(-1)
+        # One record per recipient of a send event, offsets are filled by
+        # receivers
+        self._record_events = []
+        self._record_offsets = []
+        self._unreceived = np.zeros(settings, dtype=np.int64)
+
+    def run(self, channels):
+        """ Processes events until the end of the trace or a receive event
+            whose message has not been sent. Returns the sender of the
+            message in the latter case, otherwise None.
+        """
+        index = self.index
+        process_id = self.trace.process_id
+        while self._position < len(index):
+            position = self._position
+            if index.types[position] == ord("R"):
+                sender = int(index.peers[position])
+                channel = channels[(sender, process_id)]
+                if not channel:
+                    return sender
+                self._receive(channel.popleft())
+            elif not self._last_event_times.all():
+                self._clock_single(channels)
+            else:
+                self._clock_run(channels)
+        return None
+
+    def _clock_single(self, channels):
+        """ Processes one internal event, settings without a preceding event
+            keep its time
+        """
+        position = self._position
+        time = self.index.times[position] + self.time_offsets
+        last = self._last_event_times
+        times = np.where(last != 0, np.maximum(time, last + self.diffs), time)
+        self._store(position, position + 1, times[np.newaxis], channels)
+
+    def _clock_run(self, channels):
+        """ Processes internal events up to the next receive event at once
+            (see clock_run)
+        """
+        first = self._position
+        i = np.searchsorted(self._receives, first)
+        if i < len(self._receives):
+            last = int(self._receives[i])
+        else:
+            last = len(self.index)
+        times = clock_run(self.index.times[first:last, np.newaxis] +
+                          self.time_offsets, self._last_event_times,
+                          self.diffs)
+        self._store(first, last, times, channels)
+
+    def _store(self, first, last, times, channels):
+        """ Stores times of events from first to last and sends messages of
+            send events among them
+        """
+        index = self.index
+        self.times[first:last] = times
+        self._last_event_times = times[-1].copy()
+        self._position = last
+        process_id = self.trace.process_id
+        sends = np.flatnonzero(index.types[first:last] == ord("M")) + first
+        for position in sends.tolist():
+            for target_id in index.send_targets(position).tolist():
+                record = len(self._record_events)
+                self._record_events.append(position)
+                self._record_offsets.append(self._unreceived)
+                channels[(process_id, target_id)].append(
+                    (self, record, self.times[position]))
+
+    def _receive(self, message):
+        """ Processes a receive event of the message (see _clock_receive of
+            SyncedTrace)
+        """
+        sender, record, sent_times = message
+        position = self._position
+        time = self.index.times[position] + self.time_offsets
+        last = self._last_event_times
+        times = np.maximum(sent_times + self.delays, time)
+        times = np.where(last != 0, np.maximum(times, last + self.diffs),
+                         times)
+        violations = np.maximum(times - time, 0)
+        self.time_offsets += violations
+        receive = int(np.searchsorted(self._receives, position))
+        self._violations[receive] = violations
+        self._last_violating[violations > 0] = position
+        self.times[position] = times
+        self._last_event_times = times
+        self._position = position + 1
+        sender.refill_received_time(record, sent_times, times)
+
+    def refill_received_time(self, record, sent_times, received_times):
+        """ Fills receive times of all settings into the record of a sent
+            message
+        """
+        self._record_offsets[record] = received_times - self.delays - \
+                                       sent_times
+
+    def do_backward_amortization(self):
+        """ Applies the backward amortization for every setting (see
+            do_backward_amortization of SyncedTrace)
+        """
+        if not self._record_events or self._last_violating.max() <= 0:
+            limits = None
+        else:
+            limits = np.empty(self.times.shape, dtype=np.int64)
+            limits.fill(INT64_MAX)
+            np.minimum.at(limits, np.array(self._record_events),
+                          np.array(self._record_offsets))
+        violations = np.zeros(len(self.index), dtype=np.int64)
+        for setting, last in enumerate(self._last_violating.tolist()):
+            if last <= 0:
+                continue
+            violations[self._receives] = self._violations[:, setting]
+            if limits is None:
+                setting_limits = np.empty(last, dtype=np.int64)
+                setting_limits.fill(INT64_MAX)
+            else:
+                setting_limits = limits[:last, setting]
+            offsets = backward_offsets(setting_limits[::-1],
+                                       violations[:last][::-1],
+                                       violations[last])
+            self.times[:last, setting] += offsets[::-1]
+
+    def violation_count(self, setting):
+        """ Returns the count of receive events corrected with the setting """
+        return int(np.count_nonzero(self._violations[:, setting]))
+
+    def shifts(self, setting):
+        """ Returns shifts of events against their original times """
+        return self.times[:, setting] - self.index.times - \
+               self._original_offset
+
+    def export_data(self, setting):
+        """ Returns data synchronized with the setting in a raw binary form """
+        events = EventStore()
+        events.extend(self.index.types, self.times[:, setting],
+                      self.index.offsets + 1)
+        export = bytearray(self.trace.data)
+        events.patch(export)
+        return export
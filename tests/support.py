@@ -0,0 +1,105 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+""" Shared setup of the tests. Modules of common/, parallel/ and tools/ are
+    made importable, tracelogs are generated by gentrace.py into a temporary
+    directory and synchronized within the test process by the engine of
+    multicore.py with a single worker, so no MPI is needed.
+"""
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+from Queue import Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("common", "parallel", "tools"):
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from gentrace import generate
+import tracelog as tr
+from multicore import QueueRouter
+from paralleltrace import ParallelSyncedTrace
+from schedule import run_traces
+
+
+class TracelogTestCase(unittest.TestCase):
+    """ A test with its own temporary directory for generated tracelogs """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def generate(self, process_count, event_count, **options):
+        """ Generates a tracelog (see gentrace.generate) and returns the path
+            of its *.kth
+        """
+        filename = os.path.join(self.directory, "trace.kth")
+        generate(filename, process_count, event_count, **options)
+        return filename
+
+
+class LocalRouter(QueueRouter):
+    """ Routes times among traces all synchronized by the test process, every
+        time is delivered when it is sent, so waiting for one means it is
+        never sent
+    """
+
+    def __init__(self, process_count):
+        QueueRouter.__init__(self, 0, [0] * process_count, [Queue()], 64)
+
+    def _wait_batch(self):
+        raise AssertionError("a time is waited for which is never sent")
+
+
+def open_traces(tracelog, minimal_event_diff, minimum_msg_delay,
+                index_cache=False, **options):
+    """ Returns (router, traces), ParallelSyncedTraces of all traces of
+        the tracelog exchanging times through one LocalRouter, options are
+        passed to ParallelSyncedTrace. If index_cache is True, indexes are
+        cached next to the trace files.
+    """
+    pointer_size, process_count = tr.read_header(tracelog)
+    basename = tr.trim_filename_suffix(tracelog)
+    router = LocalRouter(process_count)
+    traces = []
+    for process_id in xrange(process_count):
+        data, tracefile = tr.read_trace(basename, process_id)
+        traces.append(ParallelSyncedTrace(data, process_id, pointer_size,
+                                          minimal_event_diff,
+                                          minimum_msg_delay, True, True, None,
+                                          transport=router.endpoint(
+                                                                process_id),
+                                          index_cache=tracefile if
+                                                index_cache else None,
+                                          **options))
+    starttime = min(trace.get_init_time() for trace in traces)
+    for trace in traces:
+        trace.time_offset = trace.get_init_time() - starttime
+    return router, traces
+
+def finish_traces(router, traces):
+    """ Processes the rest of the traces including the backward amortization
+        and returns their synchronized data
+    """
+    run_traces(traces, router.poll, router.wait)
+    router.close()
+    for trace in traces:
+        trace.do_backward_amortization()
+    return [ str(trace.export_raw()) for trace in traces ]
+
+def synchronize(tracelog, minimal_event_diff, minimum_msg_delay, **options):
+    """ Synchronizes the tracelog and returns synchronized data of its traces
+        (see open_traces)
+    """
+    router, traces = open_traces(tracelog, minimal_event_diff,
+                                 minimum_msg_delay, **options)
+    return finish_traces(router, traces)
@@ -0,0 +1,101 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import unittest
+import numpy as np
+from support import TracelogTestCase, synchronize
+from batchclock import clock_run, backward_offsets
+
+
+def scalar_clock(times, last_event_time, minimal_event_diff):
+    """ Times of a run of events computed one by one as the decoder does """
+    result = []
+    last = last_event_time
+    for time in times:
+        if last != 0 and time < last + minimal_event_diff:
+            time = last + minimal_event_diff
+        last = time
+        result.append(time)
+    return result
+
+def scalar_offsets(limits, violations, initial_offset):
+    """ Offsets of the backward amortization walking events backwards one by
+        one, as the amortization did before backward_offsets
+    """
+    result = []
+    offset = initial_offset
+    for limit, violation in zip(limits, violations):
+        offset = min(offset, limit)
+        result.append(offset)
+        offset += violation
+    return result
+
+
+class ClockRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+
+    def random_times(self, count):
+        # Mostly increasing times, decreasing steps get events shifted
+        steps = self.random.randint(-20, 40, count).astype(np.int64)
+        return np.cumsum(steps) + 10 ** 6
+
+    def test_scalar_loop(self):
+        for count in (1, 2, 16, 100, 1000):
+            times = self.random_times(count)
+            for last, diff in ((1, 0), (10 ** 6, 10), (10 ** 6 + 500, 25),
+                               (2 * 10 ** 6, 1)):
+                self.assertEqual(clock_run(times, last, diff).tolist(),
+                                 scalar_clock(times.tolist(), last, diff))
+
+    def test_columns(self):
+        times = np.column_stack([ self.random_times(200) for i in xrange(3) ])
+        lasts = np.array([10 ** 6, 10 ** 6 + 100, 1], dtype=np.int64)
+        diffs = np.array([10, 0, 30], dtype=np.int64)
+        result = clock_run(times, lasts, diffs)
+        for column in xrange(3):
+            self.assertEqual(result[:, column].tolist(),
+                             scalar_clock(times[:, column].tolist(),
+                                          lasts[column], diffs[column]))
+
+
+class BackwardOffsetsTest(unittest.TestCase):
+
+    def test_scalar_loop(self):
+        random = np.random.RandomState(0)
+        unlimited = np.iinfo(np.int64).max
+        for count in (1, 2, 50, 1000):
+            # Sends limit offsets, violating receives raise them
+            kinds = random.randint(0, 4, count)
+            limits = np.where(kinds == 0, random.randint(0, 500, count),
+                              unlimited).astype(np.int64)
+            violations = np.where(kinds == 1, random.randint(1, 100, count),
+                                  0).astype(np.int64)
+            for initial in (0, 50, 1000):
+                self.assertEqual(
+                    backward_offsets(limits, violations, initial).tolist(),
+                    scalar_offsets(limits.tolist(), violations.tolist(),
+                                   initial))
+
+    def test_without_sends(self):
+        violations = np.array([0, 5, 0, 7, 0], dtype=np.int64)
+        limits = np.empty(5, dtype=np.int64)
+        limits.fill(np.iinfo(np.int64).max)
+        self.assertEqual(backward_offsets(limits, violations, 3).tolist(),
+                         [3, 3, 8, 8, 15])
+
+
+class BatchClockSynchronizationTest(TracelogTestCase):
+
+    def test_same_as_decoded(self):
+        tracelog = self.generate(4, 5000, receive_rate=0.1)
+        for settings in ((10, 5), (0, 0), (100, 20)):
+            self.assertEqual(synchronize(tracelog, *settings,
+                                         batch_clock=True),
+                             synchronize(tracelog, *settings))
+
+
+if __name__ == "__main__":
+    unittest.main()
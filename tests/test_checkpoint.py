@@ -0,0 +1,128 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import os
+import os.path
+import random
+import unittest
+from mpi4py import MPI
+from support import TracelogTestCase, open_traces, finish_traces, synchronize
+from checkpoint import Checkpointer, resume
+
+SETTINGS = (10, 5)
+
+
+class FailingTrace(object):
+    """ A trace whose state cannot be stored """
+
+    process_id = 0
+
+    def checkpoint_state(self):
+        raise IOError("no space left")
+
+
+class CheckpointTest(TracelogTestCase):
+
+    def setUp(self):
+        TracelogTestCase.setUp(self)
+        self.checkpoints = os.path.join(self.directory, "checkpoints")
+        os.makedirs(self.checkpoints)
+
+    def checkpointer(self, process_count):
+        return Checkpointer(self.checkpoints, 0,
+                            (process_count,) + SETTINGS)
+
+    def interrupt(self, tracelog, positions):
+        """ Processes traces a few events at a time and checkpoints every
+            trace once it has processed the count of events given by
+            positions (None for no checkpoint), then stops as if killed
+        """
+        router, traces = open_traces(tracelog, *SETTINGS, checkpoint=True)
+        checkpointer = self.checkpointer(len(traces))
+        waiting = dict((trace, position) for trace, position
+                       in zip(traces, positions) if position is not None)
+        while waiting:
+            router.poll()
+            for trace in traces:
+                steps = 0
+                while steps < 7 and not trace.is_pointer_at_end() and \
+                        not trace.is_blocked():
+                    trace.process_next()
+                    steps += 1
+                position = waiting.get(trace)
+                if position is not None and \
+                        (trace.get_event_index() >= position or
+                         trace.is_pointer_at_end()):
+                    checkpointer.save(trace)
+                    del waiting[trace]
+
+    def restart(self, tracelog):
+        """ Continues from the checkpoints and returns synchronized data and
+            channel_counts of traces right after they were restored
+        """
+        router, traces = open_traces(tracelog, *SETTINGS, checkpoint=True)
+        checkpointer = self.checkpointer(len(traces))
+        for trace in traces:
+            checkpointer.load(trace)
+        counts = [ trace.channel_counts() for trace in traces ]
+        resume(MPI.COMM_SELF, traces, len(traces))
+        return finish_traces(router, traces), counts
+
+    def test_resume(self):
+        tracelog = self.generate(4, 4000)
+        expected = synchronize(tracelog, *SETTINGS)
+        generator = random.Random(1)
+        # Whether some recipient got more or less messages than its sender
+        # had sent by their checkpoints
+        ahead = behind = False
+        for i in xrange(6):
+            positions = [ generator.randint(0, 1500) for j in xrange(4) ]
+            if i == 0:
+                # A trace without a checkpoint starts from the beginning
+                positions[2] = None
+            for name in os.listdir(self.checkpoints):
+                os.remove(os.path.join(self.checkpoints, name))
+            self.interrupt(tracelog, positions)
+            result, counts = self.restart(tracelog)
+            self.assertEqual(result, expected)
+            for origin_id, (sent, replied, received) in enumerate(counts):
+                for target_id, count in sent.iteritems():
+                    got = counts[target_id][2].get(origin_id, 0)
+                    ahead = ahead or got > count
+                    behind = behind or got < count
+        self.assertTrue(ahead and behind)
+
+    def test_other_settings(self):
+        tracelog = self.generate(2, 500)
+        self.interrupt(tracelog, [100, 100])
+        router, traces = open_traces(tracelog, *SETTINGS, checkpoint=True)
+        checkpointer = Checkpointer(self.checkpoints, 0, (2, 0, 0))
+        self.assertRaises(Exception, checkpointer.load, traces[0])
+
+    def test_failed_save(self):
+        tracelog = self.generate(2, 500)
+        self.interrupt(tracelog, [100, None])
+        checkpointer = self.checkpointer(2)
+        filename = checkpointer.filename(0)
+        with open(filename, "rb") as f:
+            saved = f.read()
+        self.assertRaises(IOError, checkpointer.save, FailingTrace())
+        self.assertFalse(os.path.exists(filename + ".tmp"))
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), saved)
+
+    def test_remove(self):
+        tracelog = self.generate(2, 500)
+        self.interrupt(tracelog, [100, 200])
+        checkpointer = self.checkpointer(2)
+        # A temporary file left by a process killed while saving
+        with open(checkpointer.filename(1) + ".tmp", "wb") as f:
+            f.write("partial")
+        router, traces = open_traces(tracelog, *SETTINGS)
+        checkpointer.remove(traces)
+        self.assertEqual(os.listdir(self.checkpoints), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
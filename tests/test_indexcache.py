@@ -0,0 +1,146 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import os
+import os.path
+import unittest
+from support import TracelogTestCase, synchronize
+import tracelog as tr
+from threadtrace import Trace
+from traceindex import CACHE_SUFFIX, TraceIndex, cache_key, load_index, \
+                       save_index
+
+COLUMNS = ("offsets", "times", "peers", "targets", "types")
+
+
+class IndexCacheTest(TracelogTestCase):
+
+    def setUp(self):
+        TracelogTestCase.setUp(self)
+        self.tracelog = self.generate(3, 2000)
+        self.pointer_size = tr.read_header(self.tracelog)[0]
+        self.filename = tr.trace_filename(
+                            tr.trim_filename_suffix(self.tracelog), 0)
+
+    def open_trace(self, use_mmap=False):
+        data = tr.read_trace(tr.trim_filename_suffix(self.tracelog), 0,
+                             use_mmap)[0]
+        trace = Trace(data, 0, self.pointer_size)
+        trace.index_cache = self.filename
+        return trace
+
+    def assertSameIndex(self, index, expected):
+        for column in COLUMNS:
+            self.assertEqual(getattr(index, column).tolist(),
+                             getattr(expected, column).tolist())
+
+    def rewrite_trace(self, data):
+        """ Replaces the trace file, its mtime moves on so the cache key
+            differs by the mtime too
+        """
+        stat = os.stat(self.filename)
+        with open(self.filename, "wb") as f:
+            f.write(data)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_saved_and_loaded(self):
+        trace = self.open_trace()
+        index = TraceIndex(trace.data, trace.header_size, self.pointer_size)
+        key = cache_key(self.filename)
+        save_index(self.filename, key, index, self.pointer_size,
+                   trace.header_size)
+        # The temporary file is renamed to the cache file
+        self.assertEqual([ name for name in os.listdir(self.directory)
+                           if CACHE_SUFFIX in name ],
+                         [ os.path.basename(self.filename) + CACHE_SUFFIX ])
+        for use_mmap in (False, True):
+            self.assertSameIndex(load_index(self.filename, key,
+                                            self.pointer_size,
+                                            trace.header_size, use_mmap),
+                                 index)
+
+    def test_key(self):
+        key = cache_key(self.filename)
+        self.assertEqual(cache_key(self.filename), key)
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        # The same size and mtime, a hashed byte differs
+        stat = os.stat(self.filename)
+        changed = bytearray(data)
+        changed[-5] ^= 0xff
+        with open(self.filename, "wb") as f:
+            f.write(changed)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime))
+        self.assertNotEqual(cache_key(self.filename), key)
+        self.rewrite_trace(data + "I" + "\0" * 8)
+        self.assertNotEqual(cache_key(self.filename)[0], key[0])
+
+    def test_invalid_cache(self):
+        trace = self.open_trace()
+        index = TraceIndex(trace.data, trace.header_size, self.pointer_size)
+        key = cache_key(self.filename)
+        header_size = trace.header_size
+        self.assertIsNone(load_index(self.filename, key, self.pointer_size,
+                                     header_size))
+        save_index(self.filename, key, index, self.pointer_size, header_size)
+        other_size = 4 if self.pointer_size == 8 else 8
+        self.assertIsNone(load_index(self.filename, key, other_size,
+                                     header_size))
+        self.assertIsNone(load_index(self.filename, key, self.pointer_size,
+                                     header_size + 1))
+        size, mtime, digest = key
+        self.assertIsNone(load_index(self.filename, (size, mtime + 1, digest),
+                                     self.pointer_size, header_size))
+        cache = self.filename + CACHE_SUFFIX
+        with open(cache, "rb") as f:
+            content = f.read()
+        with open(cache, "wb") as f:
+            f.write(content[:-1])
+        self.assertIsNone(load_index(self.filename, key, self.pointer_size,
+                                     header_size))
+        with open(cache, "wb") as f:
+            f.write(content[:10])
+        self.assertIsNone(load_index(self.filename, key, self.pointer_size,
+                                     header_size))
+
+    def test_build_index(self):
+        expected = self.open_trace().build_index()
+        self.assertTrue(os.path.exists(self.filename + CACHE_SUFFIX))
+        # The second build loads the cache instead of scanning
+        scan = TraceIndex.__init__
+        def fail(*args):
+            raise AssertionError("the trace was scanned again")
+        TraceIndex.__init__ = fail
+        try:
+            for use_mmap in (False, True):
+                self.assertSameIndex(self.open_trace(use_mmap).build_index(),
+                                     expected)
+        finally:
+            TraceIndex.__init__ = scan
+
+    def test_invalidated_by_change(self):
+        self.open_trace().build_index()
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        # Drops the final idle event, the cached index would point behind
+        # the data
+        self.rewrite_trace(data[:-9])
+        trace = self.open_trace()
+        index = trace.build_index()
+        self.assertSameIndex(index, TraceIndex(trace.data, trace.header_size,
+                                               self.pointer_size))
+        self.assertEqual(len(index), len(TraceIndex(data, trace.header_size,
+                                                    self.pointer_size)) - 1)
+
+    def test_cached_synchronization(self):
+        expected = synchronize(self.tracelog, 10, 5)
+        # The first run caches indexes, the second one loads them
+        for i in xrange(2):
+            self.assertEqual(synchronize(self.tracelog, 10, 5, index=True,
+                                         index_cache=True), expected)
+            self.assertTrue(os.path.exists(self.filename + CACHE_SUFFIX))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+import unittest
+from support import TracelogTestCase, synchronize
+import tracelog as tr
+from threadtrace import Trace
+import traceindex
+from traceindex import TraceIndex, IndexCursor
+
+
+class DecodedTrace(Trace):
+    """ Decodes all events one by one and keeps what the index stores """
+
+    def __init__(self, data, process_id, pointer_size):
+        Trace.__init__(self, data, process_id, pointer_size)
+        self.types = []
+        self.offsets = []
+        self.times = []
+        self.peers = []
+        self.targets = []
+        while not self.is_pointer_at_end():
+            self.process_event()
+
+    def _extra_event(self, event):
+        self.types.append(ord(event))
+        self.peers.append(-1)
+
+    def _extra_time(self, time, pointer, receive=False, origin_id=None):
+        self.offsets.append(pointer - 1)
+        self.times.append(time)
+        if receive:
+            self.peers[-1] = origin_id
+
+    def _extra_event_send(self, time, target_id):
+        self.targets.append(target_id)
+        self.peers[-1] = max(self.peers[-1], 0) + 1
+
+
+class TraceIndexTest(TracelogTestCase):
+
+    def check_tracelog(self, tracelog):
+        pointer_size, process_count = tr.read_header(tracelog)
+        basename = tr.trim_filename_suffix(tracelog)
+        for process_id in xrange(process_count):
+            data = tr.read_trace(basename, process_id)[0]
+            decoded = DecodedTrace(data, process_id, pointer_size)
+            index = TraceIndex(data, decoded.header_size, pointer_size)
+            self.assertEqual(index.types.tolist(), decoded.types)
+            self.assertEqual(index.offsets.tolist(), decoded.offsets)
+            self.assertEqual(index.times.tolist(), decoded.times)
+            self.assertEqual(index.peers.tolist(), decoded.peers)
+            self.assertEqual(index.targets.tolist(), decoded.targets)
+
+    def test_decoded_events(self):
+        self.check_tracelog(self.generate(4, 3000))
+
+    def test_pointer_size_4(self):
+        self.check_tracelog(self.generate(3, 2000, pointer_size=4))
+
+    def test_multicast(self):
+        self.check_tracelog(self.generate(5, 3000, multicast=3,
+                                          send_rate=0.5))
+
+    def test_send_targets(self):
+        tracelog = self.generate(4, 2000, multicast=3)
+        pointer_size = tr.read_header(tracelog)[0]
+        data = tr.read_trace(tr.trim_filename_suffix(tracelog), 0)[0]
+        decoded = DecodedTrace(data, 0, pointer_size)
+        index = TraceIndex(data, decoded.header_size, pointer_size)
+        targets = []
+        for i in index.positions("M"):
+            targets.extend(index.send_targets(i).tolist())
+        self.assertEqual(targets, decoded.targets)
+
+    def test_cursor_chunks(self):
+        tracelog = self.generate(2, 3000, multicast=2)
+        pointer_size = tr.read_header(tracelog)[0]
+        data = tr.read_trace(tr.trim_filename_suffix(tracelog), 0)[0]
+        index = TraceIndex(data, Trace(data, 0, pointer_size).header_size,
+                           pointer_size)
+        chunk = traceindex.CURSOR_CHUNK
+        traceindex.CURSOR_CHUNK = 50
+        try:
+            cursor = IndexCursor(index)
+            position = 0
+            while position < len(index):
+                cursor.seek(index.offsets[position])
+                self.assertEqual(cursor.position, position)
+                if cursor.sender() is not None:
+                    self.assertEqual(cursor.sender(), index.peers[position])
+                    position += 1
+                    continue
+                # A run ends by a receive event or by the end of the chunk
+                end = cursor.run_end()
+                self.assertTrue(position < end <= len(index))
+                self.assertTrue(end == cursor.start + len(cursor.types) or
+                                index.types[end] == ord("R"))
+                for i in xrange(position, end):
+                    self.assertNotEqual(index.types[i], ord("R"))
+                    self.assertEqual(cursor.targets(i - cursor.start),
+                                     index.send_targets(i).tolist())
+                position = end
+            cursor.move(len(index))
+            self.assertEqual(cursor.pointer(len(data)), len(data))
+        finally:
+            traceindex.CURSOR_CHUNK = chunk
+
+    def test_indexed_synchronization(self):
+        tracelog = self.generate(4, 4000)
+        for settings in ((10, 5), (0, 0), (100, 20)):
+            self.assertEqual(synchronize(tracelog, *settings, index=True),
+                             synchronize(tracelog, *settings))
+
+
+if __name__ == "__main__":
+    unittest.main()
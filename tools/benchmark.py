@@ -0,0 +1,157 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+""" Measures throughput of the synchronization engines on synthetic
+    tracelogs (see gentrace.py). Every engine runs as a child process, its
+    wall time and the peak resident set size of its largest process are
+    reported together with events per second and the speedup against
+    the sequential engine.
+"""
+
+import argparse
+import json
+import os
+import os.path
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time as tm
+from gentrace import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENGINES = ("sequential", "parallel", "multicore")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+                description="Measures throughput of the synchronization "
+                            "engines on synthetic tracelogs")
+    parser.add_argument("--processes", type=int, nargs="+", default=[4],
+                        help="counts of processes of generated tracelogs "
+                             "(default 4)")
+    parser.add_argument("--events", type=int, nargs="+", default=[10000],
+                        help="counts of generation steps of generated "
+                             "tracelogs (default 10000)")
+    parser.add_argument("--np", type=int, nargs="+", default=None,
+                        help="counts of MPI processes or workers the parallel "
+                             "engines run with (default the count of "
+                             "processes of the tracelog)")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES,
+                        default=list(ENGINES),
+                        help="engines to run (default all)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="count of runs of every configuration, the best "
+                             "one is reported (default 1)")
+    parser.add_argument("--min-event-diff", type=int, default=10,
+                        help="minimal event difference [ns] (default 10)")
+    parser.add_argument("--min-msg-delay", type=int, default=5,
+                        help="minimum message delay [ns] (default 5)")
+    parser.add_argument("--options", default="",
+                        help="options passed to every engine, "
+                             "e.g. --options=\"--index --batch-clock\"")
+    parser.add_argument("--mpirun", default="mpirun",
+                        help="command launching MPI programs "
+                             "(default mpirun)")
+    parser.add_argument("--multicast", type=int, default=1,
+                        help="maximal count of recipients of one send "
+                             "(default 1)")
+    parser.add_argument("--violations", type=float, default=0.1,
+                        help="probability that a receive is recorded before "
+                             "its send (default 0.1)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the generator (default 0)")
+    parser.add_argument("--json", help="file to store results to as JSON")
+    return parser.parse_args()
+
+def run(command):
+    """ Runs the command and returns its wall time [s] and the peak resident
+        set size of its largest process [kB]
+    """
+    with open(os.devnull, "w") as devnull:
+        start = tm.time()
+        process = subprocess.Popen(command, stdout=devnull)
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall_time = tm.time() - start
+    # The status was taken by wait4, Popen must not wait for it again
+    process.returncode = status
+    if status != 0:
+        raise Exception("Command failed with status {0}: {1}"
+                        .format(status, " ".join(command)))
+    return wall_time, usage.ru_maxrss
+
+def engine_command(engine, tracelog, np, args):
+    arguments = [ tracelog, str(args.min_event_diff), str(args.min_msg_delay) ]
+    arguments += shlex.split(args.options)
+    if engine == "sequential":
+        return [ sys.executable, os.path.join(ROOT, "sequential", "main.py") ] \
+               + arguments
+    if engine == "parallel":
+        return shlex.split(args.mpirun) + [ "-n", str(np), sys.executable,
+                        os.path.join(ROOT, "parallel", "main.py") ] + arguments
+    return [ sys.executable, os.path.join(ROOT, "parallel", "multicore.py") ] \
+           + arguments + [ "--workers", str(np) ]
+
+def measure(engine, tracelog, np, args):
+    """ Returns the best wall time and the peak memory of repeated runs """
+    results = [ run(engine_command(engine, tracelog, np, args))
+                for i in xrange(args.repeat) ]
+    return min(r[0] for r in results), max(r[1] for r in results)
+
+def print_row(values):
+    print "{0:<11} {1:>9} {2:>10} {3:>4} {4:>10} {5:>12} {6:>10} {7:>8}" \
+          .format(*values)
+
+def main():
+    args = parse_args()
+    results = []
+    directory = tempfile.mkdtemp(prefix="slc-benchmark-")
+    print_row(("engine", "processes", "events", "np", "time [s]", "events/s",
+               "RSS [MB]", "speedup"))
+    try:
+        for process_count in args.processes:
+            for steps in args.events:
+                folder = os.path.join(directory,
+                                      "{0}-{1}".format(process_count, steps))
+                os.makedirs(folder)
+                tracelog = os.path.join(folder, "trace.kth")
+                events = generate(tracelog, process_count, steps,
+                                  multicast=args.multicast,
+                                  violations=args.violations, seed=args.seed)
+                sequential_time = None
+                for engine in args.engines:
+                    counts = [ 1 ]
+                    if engine != "sequential":
+                        counts = args.np or [ process_count ]
+                    for np in counts:
+                        wall_time, rss = measure(engine, tracelog, np, args)
+                        if engine == "sequential":
+                            sequential_time = wall_time
+                        result = { "engine": engine,
+                                   "processes": process_count,
+                                   "events": events,
+                                   "np": np,
+                                   "time": wall_time,
+                                   "events_per_second": events / wall_time,
+                                   "peak_rss_kb": rss }
+                        speedup = "-"
+                        if sequential_time is not None:
+                            result["speedup"] = sequential_time / wall_time
+                            speedup = "{0:.2f}".format(result["speedup"])
+                        results.append(result)
+                        print_row((engine, process_count, events, np,
+                                   "{0:.3f}".format(wall_time),
+                                   "{0:.0f}".format(events / wall_time),
+                                   "{0:.1f}".format(rss / 1024.0), speedup))
+                shutil.rmtree(folder)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
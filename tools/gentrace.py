@@ -0,0 +1,237 @@
+#
+#    Copyright (C) 2016 Tomas Panoc
+#
+
+""" Generates a synthetic Kaira tracelog, a *.kth and one *-<pid>-0.ktt per
+    process. Processes fire transitions, send and receive messages in one
+    global random order, so every receive has its message sent before and
+    the tracelog can always be synchronized.
+"""
+
+import argparse
+import random
+import struct
+import os.path
+
+struct_basic = struct.Struct("<Q")
+struct_transition_fired = struct.Struct("<Qi")
+struct_send = struct.Struct("<QQii")
+struct_receive = struct.Struct("<Qi")
+struct_int = struct.Struct("<i")
+struct_double = struct.Struct("<d")
+struct_tokens = { 4: struct.Struct("<Li"), 8: struct.Struct("<Qi") }
+
+INIT_TIME = 10 ** 9
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+                description="Generates a synthetic Kaira tracelog")
+    parser.add_argument("tracelog", help="file path of the *.kth to create")
+    parser.add_argument("process_count", type=int, help="count of processes")
+    parser.add_argument("event_count", type=int,
+                        help="count of generation steps, each writes one "
+                             "event or a few tied events")
+    parser.add_argument("--pointer-size", type=int, choices=(4, 8),
+                        default=8, help="size of token pointers (default 8)")
+    parser.add_argument("--tokens", type=float, default=0.5,
+                        help="probability that an event carries token "
+                             "payloads (default 0.5)")
+    parser.add_argument("--send-rate", type=float, default=0.25,
+                        help="probability that a step fires a transition "
+                             "sending messages (default 0.25)")
+    parser.add_argument("--receive-rate", type=float, default=0.35,
+                        help="probability that a step receives a pending "
+                             "message (default 0.35)")
+    parser.add_argument("--multicast", type=int, default=1,
+                        help="maximal count of recipients of one send "
+                             "(default 1)")
+    parser.add_argument("--violations", type=float, default=0.1,
+                        help="probability that a receive is recorded before "
+                             "its send (default 0.1)")
+    parser.add_argument("--skew", type=int, default=1000,
+                        help="maximal difference of init times of processes "
+                             "[ns] (default 1000)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random generator (default 0)")
+    return parser.parse_args()
+
+def generate(filename, process_count, event_count, pointer_size=8, tokens=0.5,
+             send_rate=0.25, receive_rate=0.35, multicast=1, violations=0.1,
+             skew=1000, seed=0):
+    """ Writes the tracelog and returns the count of written events (events
+        with a time, tied quit, end and send events included)
+
+        Arguments:
+        filename -- path of the *.kth, traces are written next to it
+        process_count -- count of processes
+        event_count -- count of generation steps
+        pointer_size -- size of token pointers, 4 or 8
+        tokens -- probability that an event carries token payloads
+        send_rate -- probability that a step fires a transition with sends
+        receive_rate -- probability that a step receives a pending message
+        multicast -- maximal count of recipients of one send
+        violations -- probability that a receive is recorded before its send
+        skew -- maximal difference of init times of processes [ns]
+        seed -- seed of the random generator
+    """
+    generator = _Generator(process_count, pointer_size, tokens, multicast,
+                           violations, random.Random(seed))
+    for i in xrange(event_count):
+        generator.step(send_rate, receive_rate)
+    generator.finish()
+
+    with open(filename, "w") as f:
+        f.write('<header pointer-size="{0}" process-count="{1}" />\n'
+                .format(pointer_size, process_count))
+        f.write("<project>synthetic</project>\n")
+    basename = os.path.splitext(filename)[0]
+    for process_id, data in enumerate(generator.traces):
+        init_time = INIT_TIME + generator.random.randint(0, skew)
+        with open("{0}-{1}-0.ktt".format(basename, process_id), "wb") as f:
+            f.write("KairaThreadTrace\x001\x00inittime\x00{0}\x00\x00\x00"
+                    .format(init_time))
+            f.write(data)
+    return generator.count
+
+
+class _Generator(object):
+
+    def __init__(self, process_count, pointer_size, tokens, multicast,
+                 violations, random):
+        self.random = random
+        self.tokens = tokens
+        self.multicast = max(1, min(multicast, process_count - 1))
+        self.violations = violations
+        self.struct_token = struct_tokens[pointer_size]
+        self.traces = [ bytearray() for i in xrange(process_count) ]
+        self.clocks = [ random.randint(0, 100) for i in xrange(process_count) ]
+        # Sent times of messages not received yet, (sender, receiver) -> list
+        self.pending = {}
+        self.count = 0
+
+    def step(self, send_rate, receive_rate):
+        process_id = self.random.randrange(len(self.traces))
+        self._advance(process_id)
+        senders = [ sender for (sender, receiver), times
+                    in self.pending.iteritems()
+                    if receiver == process_id and times ]
+        r = self.random.random()
+        if senders and r < receive_rate:
+            self._receive(process_id, self.random.choice(senders))
+            return
+        r = self.random.random()
+        if len(self.traces) > 1 and r < send_rate:
+            self._transition(process_id, True)
+        elif r < 0.6:
+            self._transition(process_id, False)
+        elif r < 0.75:
+            self._event(process_id, "F", struct_basic.pack(
+                                                self.clocks[process_id]))
+            self._token_values(process_id)
+        elif r < 0.9:
+            self._event(process_id, "I", struct_basic.pack(
+                                                self.clocks[process_id]))
+        else:
+            self._event(process_id, "S", struct_transition_fired.pack(
+                                                self.clocks[process_id], 0))
+            self._token_values(process_id)
+
+    def finish(self):
+        """ Receives all pending messages and ends every trace by an idle
+            event
+        """
+        for (sender, receiver), times in sorted(self.pending.iteritems()):
+            for time in times:
+                self.clocks[receiver] = max(self.clocks[receiver], time)
+                self._advance(receiver)
+                self._event(receiver, "R", struct_receive.pack(
+                                                self.clocks[receiver], sender))
+        self.pending.clear()
+        for process_id in xrange(len(self.traces)):
+            self._advance(process_id)
+            self._event(process_id, "I", struct_basic.pack(
+                                                self.clocks[process_id]))
+
+    def _advance(self, process_id):
+        self.clocks[process_id] += self.random.randint(1, 50)
+
+    def _event(self, process_id, t, values):
+        self.traces[process_id] += t + values
+        self.count += 1
+
+    def _receive(self, process_id, sender):
+        sent_time = self.pending[(sender, process_id)].pop(0)
+        if self.random.random() < self.violations:
+            time = max(0, sent_time - self.random.randint(1, 200))
+        else:
+            time = max(self.clocks[process_id],
+                       sent_time + self.random.randint(1, 100))
+        self.clocks[process_id] = max(self.clocks[process_id], time)
+        self._event(process_id, "R", struct_receive.pack(time, sender))
+        self._token_values(process_id)
+        self._end(process_id)
+
+    def _transition(self, process_id, send):
+        data = self.traces[process_id]
+        self._event(process_id, "T", struct_transition_fired.pack(
+                                        self.clocks[process_id],
+                                        self.random.randint(0, 9)))
+        if self.random.random() < self.tokens:
+            data += "r" + self.struct_token.pack(self.random.randint(1, 1000),
+                                                 self.random.randint(0, 5))
+        if self.random.random() < 0.1:
+            self._advance(process_id)
+            self._event(process_id, "Q", struct_basic.pack(
+                                                self.clocks[process_id]))
+        self._token_values(process_id)
+        if send:
+            for i in xrange(self.random.randint(1, 2)):
+                self._send(process_id)
+        self._end(process_id)
+
+    def _send(self, process_id):
+        self._advance(process_id)
+        time = self.clocks[process_id]
+        targets = self.random.sample(
+                    [ i for i in xrange(len(self.traces)) if i != process_id ],
+                    self.random.randint(1, self.multicast))
+        self._event(process_id, "M", struct_send.pack(time, 16, 1,
+                                                      len(targets)))
+        for target in targets:
+            self.traces[process_id] += struct_int.pack(target)
+            self.pending.setdefault((process_id, target), []).append(time)
+
+    def _end(self, process_id):
+        if self.random.random() < 0.3:
+            self._advance(process_id)
+            self._event(process_id, "X", struct_basic.pack(
+                                                self.clocks[process_id]))
+
+    def _token_values(self, process_id):
+        if self.random.random() >= self.tokens:
+            return
+        data = self.traces[process_id]
+        for i in xrange(self.random.randint(1, 3)):
+            data += "t" + self.struct_token.pack(self.random.randint(1, 1000),
+                                                 self.random.randint(0, 5))
+            for j in xrange(self.random.randint(0, 2)):
+                c = self.random.choice("ids")
+                if c == "i":
+                    data += "i" + struct_int.pack(self.random.randint(-5, 5))
+                elif c == "d":
+                    data += "d" + struct_double.pack(self.random.random())
+                else:
+                    data += "s" + "abc"[:self.random.randint(0, 3)] + "\x00"
+
+
+def main():
+    args = parse_args()
+    count = generate(args.tracelog, args.process_count, args.event_count,
+                     args.pointer_size, args.tokens, args.send_rate,
+                     args.receive_rate, args.multicast, args.violations,
+                     args.skew, args.seed)
+    print "Events: {0}".format(count)
+
+if __name__ == "__main__":
+    main()